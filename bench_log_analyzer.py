@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import gzip
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import typing as tp
+
+import log_analyzer
+
+try:
+    import resource
+except ImportError:  # нет на Windows
+    resource = None
+
+LINE_TEMPLATE = (
+    '{remote_addr} -  - [29/Jun/2017:{hour:02d}:{minute:02d}:{second:02d} +0300] "{method} {url} HTTP/1.1" '
+    '200 {body_bytes_sent} "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" '
+    '"1498697422-{request_id}-4708-9752759" "dc7161be3" {request_time:.3f}'
+)
+URL_TEMPLATES = (
+    "/api/v2/banner/{id}",
+    "/api/v2/group/{id}/statistic/sites/?date_type=day&date_from=2017-06-28&date_to=2017-06-28",
+    "/api/1/photogenic_banners/list/?server_name=WIN7RB{id}",
+    "/api/v2/slot/{id}/groups",
+    "/export/appinstall_raw/2017-06-{id}/",
+    "/agency/outlays/{id}/banner/",
+)
+MALFORMED_LINES = (
+    "",
+    "garbage",
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 927',
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1 200 927 "-" "-" "-" "-" "-" -',
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "" 200 927 "-" "-" "-" "-" "-" 0.1',
+    'x "GET /a HTTP/1.1" inf',
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 927 "-" "-" "-" "-" "-" nan',
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 927 "-" "-" "-" "-" "-"0.1',
+)
+
+
+def generate_lines(
+        count: int,
+        seed: int = 0,
+        url_count: int = 10000,
+        zipf_s: float = 1.1,
+        latency: str = "lognormal",
+        malformed_ratio: float = 0.0,
+) -> tp.List[str]:
+    """Детерминированный синтетический лог ui_short: популярность url по Ципфу с параметром zipf_s,
+    время ответа логнормальное или экспоненциальное, доля malformed_ratio испорченных строк"""
+    rnd = random.Random(seed)
+    urls = [URL_TEMPLATES[idx % len(URL_TEMPLATES)].format(id=idx) for idx in range(url_count)]
+    cum_weights = list(itertools.accumulate(1.0 / (rank ** zipf_s) for rank in range(1, url_count + 1)))
+    url_choices = rnd.choices(urls, cum_weights=cum_weights, k=count)
+    if latency == "lognormal":
+        latencies = [rnd.lognormvariate(-1.5, 1.0) for _ in range(count)]
+    elif latency == "exp":
+        latencies = [rnd.expovariate(2.0) for _ in range(count)]
+    else:
+        raise ValueError(f"unknown latency distribution {latency}")
+    lines = []
+    for idx in range(count):
+        if malformed_ratio > 0 and rnd.random() < malformed_ratio:
+            lines.append(rnd.choice(MALFORMED_LINES))
+            continue
+        seconds = idx * 86400 // max(count, 1)
+        lines.append(LINE_TEMPLATE.format(
+            remote_addr=f"1.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}",
+            hour=seconds // 3600,
+            minute=seconds // 60 % 60,
+            second=seconds % 60,
+            method="GET" if rnd.random() < 0.9 else "POST",
+            url=url_choices[idx],
+            body_bytes_sent=rnd.randint(0, 100000),
+            request_id=rnd.randint(1000000000, 9999999999),
+            request_time=latencies[idx],
+        ))
+    return lines
+
+
+def write_log(log_name: str, lines: tp.List[str]) -> None:
+    opener = gzip.open if log_name.lower().endswith(".gz") else open
+    with opener(log_name, mode="wt", encoding="utf8") as file:
+        file.write("\n".join(lines) + "\n")
+
+
+def peak_rss_mb() -> float:
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def _read_gzip_log_simple(log_name: str) -> tp.Generator[str, None, None]:
+    with gzip.open(log_name, mode="rt", encoding="utf8") as file:
+        for line in file:
+            yield line.rstrip()
+
+
+def _parse_all(parser: tp.Callable[[tp.Any], tp.Any], items: tp.Iterable[tp.Any]) -> int:
+    count = 0
+    for item in items:
+        count += 1
+        try:
+            parser(item)
+        except Exception:
+            pass
+    return count
+
+
+def _aggregate_mmap(log_name: str) -> tp.Tuple[tp.Dict[str, log_analyzer.StatInfo], int]:
+    with log_analyzer.MmapLogReader(log_name) as reader:
+        return log_analyzer.process_log_info(reader, reader.parse_request_fields)
+
+
+def run_stages(log_name: str, report_size: int) -> tp.Dict[str, tp.Dict[str, float]]:
+    """Замеряет каждую стадию обработки лога отдельно: чтение, разбиение, разбор, агрегация, статистика, репорт.
+    peak_rss_mb - пиковый RSS процесса с начала замеров (ru_maxrss только растет), peak_rss_growth_mb - на сколько
+    стадия подняла этот пик"""
+    results = {}
+    line_count = 0
+
+    def stage(name: str, func: tp.Callable[[], tp.Any]) -> tp.Any:
+        peak_started = peak_rss_mb()
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        value = func()
+        elapsed = time.perf_counter() - started
+        peak = peak_rss_mb()
+        results[name] = {
+            "seconds": round(elapsed, 4),
+            "cpu_seconds": round(time.process_time() - cpu_started, 4),
+            "lines_per_sec": round((line_count or len(value)) / elapsed) if elapsed > 0 else 0,
+            "peak_rss_mb": round(peak, 1),
+            "peak_rss_growth_mb": round(peak - peak_started, 1),
+        }
+        return value
+
+    lines = stage("read", lambda: list(log_analyzer._read_log(log_name)))
+    line_count = len(lines)
+    if log_name.lower().endswith(".gz"):
+        stage("read_gzip_open", lambda: sum(1 for _ in _read_gzip_log_simple(log_name)))
+        stage("read_gzip_pipelined", lambda: sum(1 for _ in log_analyzer._read_gzip_log(log_name)))
+        # распаковка окупается только вместе с разбором: конвейер перекрывает zlib и разбор строк
+        stage("aggregate_gzip_open", lambda: log_analyzer.process_log_info(_read_gzip_log_simple(log_name)))
+        stage("aggregate_gzip_pipelined", lambda: log_analyzer.process_log_info(log_analyzer._read_gzip_log(log_name)))
+    stage("split", lambda: [log_analyzer.log_line_split(line) for line in lines])
+    # прежний разбор целиком, вместе с разбиением строки регулярным выражением, как его вызывает process_log_info
+    stage("parse_legacy", lambda: _parse_all(log_analyzer.parse_request_fields_legacy, lines))
+    stage("parse_fast", lambda: _parse_all(log_analyzer.parse_request_fields, lines))
+    stat_info, _ = stage("aggregate", lambda: log_analyzer.process_log_info(lines))
+    if log_analyzer.np is not None:
+        numpy_info, _ = stage("aggregate_numpy", lambda: log_analyzer.process_log_info_numpy(lines))
+        stage("stats_numpy", lambda: log_analyzer.calculate_stat_info(numpy_info, report_size))
+    if not log_name.lower().endswith(".gz"):
+        stage("aggregate_mmap", lambda: _aggregate_mmap(log_name))
+    rows = stage("stats", lambda: log_analyzer.calculate_stat_info(stat_info, report_size))
+    with tempfile.TemporaryDirectory() as folder:
+        stage("render", lambda: log_analyzer.create_html_file(os.path.join(folder, "report.html"), rows))
+    stage("process_log_file", lambda: log_analyzer.process_log_file(log_name, report_size=report_size))
+    return results
+
+
+def compare_with_baseline(
+        results: tp.Dict[str, tp.Dict[str, float]],
+        baseline: tp.Dict[str, tp.Dict[str, float]],
+        threshold: float,
+) -> tp.List[str]:
+    """Стадии, пропускная способность которых упала больше чем на threshold относительно baseline"""
+    regressions = []
+    for name, stage in results.items():
+        if name not in baseline or baseline[name]["lines_per_sec"] <= 0:
+            continue
+        ratio = stage["lines_per_sec"] / baseline[name]["lines_per_sec"]
+        if ratio < 1.0 - threshold:
+            regressions.append(f"{name}: {stage['lines_per_sec']:,} lines/sec is {ratio:.2f}x of baseline")
+    return regressions
+
+
+def print_results(results: tp.Dict[str, tp.Dict[str, float]]) -> None:
+    print(f"{'stage':>24} {'seconds':>9} {'cpu':>9} {'lines/sec':>12} {'peak rss so far, MB':>20} "
+          f"{'stage peak growth, MB':>22}")
+    for name, stage in results.items():
+        print(f"{name:>24} {stage['seconds']:>9.3f} {stage['cpu_seconds']:>9.3f} {stage['lines_per_sec']:>12,} "
+              f"{stage['peak_rss_mb']:>20.1f} {stage['peak_rss_growth_mb']:>22.1f}")
+
+
+def main(argv: tp.List[str]) -> int:
+    parser = argparse.ArgumentParser(description="log_analyzer benchmark on a synthetic or given ui_short log")
+    parser.add_argument("--log", help="benchmark this log instead of a synthetic one")
+    parser.add_argument("--generate", help="only write a synthetic log to this path (.gz for gzip) and exit")
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--urls", type=int, default=10000, help="url cardinality")
+    parser.add_argument("--zipf", type=float, default=1.1, help="zipf exponent of url popularity")
+    parser.add_argument("--latency", choices=("lognormal", "exp"), default="lognormal")
+    parser.add_argument("--malformed", type=float, default=0.0, help="ratio of malformed lines")
+    parser.add_argument("--gzip", action="store_true", help="benchmark a gzipped synthetic log")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report-size", type=int, default=1000)
+    parser.add_argument("--save-baseline", help="save results as a JSON baseline")
+    parser.add_argument("--baseline", help="compare results with a JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed throughput drop against baseline")
+    args = parser.parse_args(argv)
+
+    def generate() -> tp.List[str]:
+        return generate_lines(args.lines, args.seed, args.urls, args.zipf, args.latency, args.malformed)
+
+    if args.generate:
+        write_log(args.generate, generate())
+        return 0
+    logging.disable(logging.CRITICAL)  # трейсы испорченных строк не нужны в замерах
+    with tempfile.TemporaryDirectory() as folder:
+        log_name = args.log
+        if log_name is None:
+            log_name = os.path.join(folder, "nginx-access-ui.log-29062017" + (".gz" if args.gzip else ""))
+            write_log(log_name, generate())
+        results = run_stages(log_name, args.report_size)
+    print_results(results)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_with_baseline(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,18 +1,47 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import argparse
+import array
+import asyncio
+import collections
+import functools
+import concurrent.futures
+import contextlib
+import csv
 import datetime
 import gzip
+import heapq
+import html
 import json
 import logging
+import math
+import mmap
 import os
 import os.path
 import pathlib
+import pickle
+import queue
 import re
+import signal
+import struct
+import sqlite3
 import sys
+import threading
 import time
 import typing as tp
+import zlib
 from dataclasses import dataclass
 
+try:
+    import resource
+except ImportError:  # нет на Windows
+    resource = None
+
+try:
+    import numpy as np
+except ImportError:  # необязательная зависимость, без нее агрегация идет на чистом python
+    np = None
+
 # log_format ui_short '$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
 #                     '$status $body_bytes_sent "$http_referer" '
 #                     '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
@@ -21,18 +50,94 @@ from dataclasses import dataclass
 default_config = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR": "./reports",
-    "LOG_DIR": "./log",
+    "LOG_DIR": "./log",  # или список папок, по папке на хост - тогда репорт строится по логам дня со всех хостов
     "ERROR_MAX_RATIO": 0.4,  # отношение ошибочных строк к общим, больше которого - ошибка обработки лога
     "LOG_FILE": None,  # файл для лога, если нет - в консоль
+    "WORKERS": 1,  # число процессов для разбора несжатого лога, 1 - последовательный разбор
+    "CHECKPOINT_DIR": None,  # папка для контрольных точек растущих логов, если нет - лог всегда читается целиком
+    "BACKFILL_WORKERS": 4,  # сколько логов одновременно разбирается в режиме --backfill
+    "BACKFILL_MEMORY_LIMIT_MB": 0,  # ограничение памяти процесса в режиме --backfill, 0 - без ограничения
+    "CACHE_DIR": None,  # папка для бинарного кэша агрегатов по логам, если нет - кэш не используется
+    "URL_NORMALIZATION": None,  # правила сведения url к эндпоинтам (см. UrlNormalizer), если нет - url как есть
+    "WRITE_METRICS": False,  # писать рядом с репортом report-<дата>.metrics.json с замерами стадий
+    "LOG_INDEX_FILE": None,  # файл индекса логов LOG_DIR, если нет - папка просматривается при каждом запуске
+    "WATCH_POLL_INTERVAL": 5,  # режим --watch: как часто (секунд) проверять LOG_DIR и дочитывать активный лог
+    "WATCH_REPORT_INTERVAL": 60,  # режим --watch: как часто (секунд) перестраивать репорт, если лог изменился
+    "TIME_BUCKET": None,  # "1m", "5m" или "1h" - писать рядом с репортом таблицу по интервалам суток
+    "TIME_SERIES_TOP_URLS": 20,  # сколько первых url репорта попадает в таблицу по интервалам
+    "PERCENTILES": False,  # колонки time_p90, time_p95, time_p99 в репорте (по скетчу с ошибкой до 1%)
+    "AGGREGATION_BACKEND": "python",  # "numpy" - векторизованная агрегация, если numpy установлен
+    "HISTORY_DB": None,  # база SQLite для дневных агрегатов всех url, если нет - история не ведется
+    # режим --compare: url попадает в репорт регрессий, если хоть одна метрика выросла больше чем в заданное
+    # число раз, и за день у него не меньше min_count запросов
+    "REGRESSION_THRESHOLDS": {"time_sum": 1.2, "time_avg": 1.2, "time_med": 1.2, "min_count": 10},
 }
 
 
+# полный шаблон строки ui_short, нужен только когда запрашиваются все поля записи
+UI_SHORT_RE = re.compile(
+    r'(?P<remote_addr>\S+)\s+(?P<remote_user>\S+)\s+(?P<http_x_real_ip>\S+)\s+\[(?P<time_local_raw>[^\]]*)]\s+'
+    r'"(?P<request>[^"]*)"\s+(?P<status>\S+)\s+(?P<body_bytes_sent>\S+)\s+"(?P<http_referer>[^"]*)"\s+'
+    r'"(?P<http_user_agent>[^"]*)"\s+"(?P<http_x_forwarded_for>[^"]*)"\s+"(?P<http_X_REQUEST_ID>[^"]*)"\s+'
+    r'"(?P<http_X_RB_USER>[^"]*)"\s+(?P<request_time>\S+)\s*$'
+)
+TIME_LOCAL_FORMAT = "%d/%b/%Y:%H:%M:%S %z"
+
+
+def request_url(request: str) -> str:
+    fields = request.split()
+    if len(fields) > 2:
+        return fields[1]
+    else:
+        return fields[0]
+
+
+class UrlNormalizer:
+    """Сводит url с идентификаторами к шаблону эндпоинта, например /api/v2/banner/23964943 -> /api/v2/banner/{id}.
+    Правила компилируются один раз, уже виденные url берутся из ограниченного LRU-кэша.
+    Правила (ключ URL_NORMALIZATION конфига):
+        "strip_query" - отбрасывать query string
+        "collapse_ids", "collapse_uuids", "collapse_hashes" - заменять сегменты пути из цифр, uuid
+            и hex-хэши (от 16 символов) на {id}, {uuid} и {hash}
+        "templates" - список пар [регулярное выражение, замена], применяются по порядку после остальных
+        "cache_size" - размер кэша нормализованных url"""
+
+    SEGMENT_RULES = (
+        ("collapse_uuids", r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}", "{uuid}"),
+        ("collapse_ids", r"\d+", "{id}"),
+        ("collapse_hashes", r"[0-9a-fA-F]{16,}", "{hash}"),
+    )
+
+    def __init__(self, rules: tp.Dict[str, tp.Any]):
+        self._rules = rules
+        self._strip_query = bool(rules.get("strip_query", False))
+        self._patterns = [
+            (re.compile(rf"(?<=/){pattern}(?=/|\?|$)"), replacement)
+            for key, pattern, replacement in self.SEGMENT_RULES
+            if rules.get(key, False)
+        ]
+        self._patterns += [(re.compile(pattern), replacement) for pattern, replacement in rules.get("templates", [])]
+        self.cache_size = rules.get("cache_size", 100000)
+        self.normalize = functools.lru_cache(maxsize=self.cache_size)(self._normalize)
+        self.fingerprint = zlib.crc32(json.dumps(rules, sort_keys=True).encode("utf8"))
+
+    def __reduce__(self) -> tp.Tuple[tp.Any, ...]:  # для передачи в процессы пула, кэш не переносится
+        return UrlNormalizer, (self._rules,)
+
+    def _normalize(self, url: str) -> str:
+        if self._strip_query:
+            url = url.partition("?")[0]
+        for pattern, replacement in self._patterns:
+            url = pattern.sub(replacement, url)
+        return sys.intern(url)
+
+
 @dataclass
 class LogInfo:
     remote_addr = ""
     remote_user = ""
     http_x_real_ip = ""
-    time_local = datetime.date
+    time_local_raw = ""  # $time_local без скобок, разбирается только при обращении к time_local
     request = ""
     status = ""
     body_bytes_sent = ""
@@ -42,48 +147,194 @@ class LogInfo:
     http_X_REQUEST_ID = ""
     http_X_RB_USER = ""
     request_time = 0.0
+    _time_local = None
+
+    @property
+    def time_local(self) -> time.struct_time:
+        if self._time_local is None:
+            self._time_local = time.strptime(self.time_local_raw, TIME_LOCAL_FORMAT)
+        return self._time_local
 
     def request_clear(self) -> str:
-        fields = self.request.split()
-        if len(fields) > 2:
-            return fields[1]
-        else:
-            return fields[0]
+        return request_url(self.request)
+
+
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_MIN_VALUE = 1e-4  # меньшие времена считаются нулевыми, nginx пишет $request_time с точностью до мс
+_SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+_SKETCH_LOG_GAMMA = math.log(_SKETCH_GAMMA)
+
+
+class QuantileSketch:
+    """Логарифмическая гистограмма времен в духе DDSketch: время x попадает в корзину ceil(log(x) / log(gamma)),
+    gamma = (1 + a) / (1 - a), и любой квантиль восстанавливается с относительной ошибкой не больше
+    a = SKETCH_RELATIVE_ACCURACY. Число корзин зависит от разброса времен, а не от числа запросов
+    (не больше ~1200 на диапазон 1e-4..1e6 с), скетчи частей лога и разных логов сливаются сложением счетчиков"""
+
+    __slots__ = ("_bins", "_zero_count", "_count")
+
+    def __init__(self):
+        self._bins = {}
+        self._zero_count = 0
+        self._count = 0
+
+    @classmethod
+    def from_bins(cls, zero_count: int, bins: tp.Iterable[tp.Tuple[int, int]]) -> "QuantileSketch":
+        sketch = cls()
+        sketch._bins = dict(bins)
+        sketch._zero_count = zero_count
+        sketch._count = zero_count + sum(sketch._bins.values())
+        return sketch
+
+    def add(self, value: float) -> None:
+        self._count += 1
+        if value < SKETCH_MIN_VALUE:
+            self._zero_count += 1
+            return
+        index = math.ceil(math.log(value) / _SKETCH_LOG_GAMMA)
+        bins = self._bins
+        bins[index] = bins.get(index, 0) + 1
+
+    def merge(self, other: "QuantileSketch") -> None:
+        bins = self._bins
+        for index, count in other._bins.items():
+            bins[index] = bins.get(index, 0) + count
+        self._zero_count += other._zero_count
+        self._count += other._count
+
+    def bins(self) -> tp.List[tp.Tuple[int, int]]:
+        return sorted(self._bins.items())
+
+    def zero_count(self) -> int:
+        return self._zero_count
+
+    def count(self) -> int:
+        return self._count
+
+    def quantile(self, q: float) -> float:
+        """Оценка элемента с номером floor(q * (count - 1)) в отсортированном ряду времен"""
+        assert (self._count > 0 and 0.0 <= q <= 1.0)
+        rank = q * (self._count - 1)
+        seen = self._zero_count
+        if seen > rank:
+            return 0.0
+        for index, count in self.bins():
+            seen += count
+            if seen > rank:
+                return 2.0 * _SKETCH_GAMMA ** index / (_SKETCH_GAMMA + 1.0)
+        raise AssertionError("sketch counters are inconsistent")
 
 
 class StatInfo:
-    def __init__(self, request: str):
+    """Агрегат времен запросов по одному url: count/sum/max считаются на лету,
+    сами времена хранятся в компактном массиве double только для медианы.
+    С sketch=True времена еще попадают в QuantileSketch для перцентилей"""
+
+    __slots__ = ("_request", "_request_times", "_count", "_sum", "_max", "_median", "_sketch")
+
+    def __init__(self, request: str, keep_times: bool = True, sketch: bool = False):
         assert (len(request) > 0)
         self._request = request
-        self._request_times = []
+        self._request_times = array.array("d") if keep_times else None
+        self._count = 0
+        self._sum = 0.0
+        self._max = float("-inf")
+        self._median = None
+        self._sketch = QuantileSketch() if sketch else None
+
+    @classmethod
+    def from_aggregate(
+            cls,
+            request: str,
+            count: int,
+            times_sum: float,
+            times_max: float,
+            median: float,
+            sketch: tp.Optional[QuantileSketch] = None,
+    ) -> "StatInfo":
+        """Восстанавливает агрегат без времен запросов, например из кэша"""
+        info = cls(request, keep_times=False)
+        info._count = count
+        info._sum = times_sum
+        info._max = times_max
+        info._median = median
+        info._sketch = sketch
+        return info
+
+    def freeze(self) -> None:
+        """Считает медиану и освобождает массив времен, дальше агрегат только для чтения"""
+        if self._request_times is not None:
+            self._median = self.request_times_median()
+            self._request_times = None
 
     def append_time(self, request_time: float) -> None:
-        self._request_times.append(request_time)
+        self._count += 1
+        self._sum += request_time
+        if request_time > self._max:
+            self._max = request_time
+        if self._request_times is not None:
+            self._request_times.append(request_time)
+        if self._sketch is not None:
+            self._sketch.add(request_time)
+
+    def merge(self, other: "StatInfo") -> None:
+        """Добавляет к агрегату данные более позднего участка того же лога. Времена досуммируются
+        по одному, поэтому сумма совпадает с последовательным разбором до последнего бита.
+        Если времена есть не у обоих агрегатов, медиана дальше оценивается по скетчу, а без скетчей
+        у обоих слияние отклоняется: точную медиану по такой паре уже не посчитать"""
+        if (self._request_times is None or other._request_times is None) and (
+                self._sketch is None or other._sketch is None):
+            raise ValueError(
+                f"cannot merge aggregates for {self._request}: request times were not kept on both sides "
+                "and there are no sketches, the median would be lost"
+            )
+        if self._request_times is not None and other._request_times is not None:
+            for request_time in other._request_times:
+                self._sum += request_time
+            self._request_times.extend(other._request_times)
+        else:
+            self._sum += other._sum
+            self._request_times = None
+        self._median = None
+        if self._sketch is not None and other._sketch is not None:
+            self._sketch.merge(other._sketch)
+        else:
+            self._sketch = None
+        self._count += other._count
+        if other._max > self._max:
+            self._max = other._max
 
     def count(self) -> int:
-        return len(self._request_times)
+        return self._count
+
+    def sketch(self) -> tp.Optional[QuantileSketch]:
+        return self._sketch
 
     def request_times_sum(self) -> float:
-        return sum(self._request_times)
+        return self._sum
 
     def request_times_avg(self) -> float:
-        assert (len(self._request_times) > 0)
-        return sum(self._request_times) / len(self._request_times)
+        assert (self._count > 0)
+        return self._sum / self._count
 
     def request_times_max(self) -> float:
-        assert (len(self._request_times) > 0)
-        return max(self._request_times)
+        assert (self._count > 0)
+        return self._max
 
     def request_times_median(self) -> float:
-        assert (len(self._request_times) > 0)
+        assert (self._count > 0)
+        if self._request_times is None:
+            if self._median is not None:
+                return self._median
+            if self._sketch is not None:  # после слияния с агрегатом без времен
+                return self._sketch.quantile(0.5)
+            raise RuntimeError(f"request times for {self._request} were not kept, median is unavailable")
         sorted_times = sorted(self._request_times)
         length = len(sorted_times)
-        if length == 1:
-            return 0.5 * sorted_times[0]
-        elif length % 2 == 0:  # в четных рядах - полусумма элементов
+        if length % 2 == 0:  # в четных рядах - полусумма элементов
             return 0.5 * (sorted_times[length // 2] + sorted_times[length // 2 - 1])
         else:  # иначе - элемент посредине
-            return sorted_times[length // 2 + 1]
+            return sorted_times[length // 2]
 
 
 def parse_log_info(data: tp.List[str]) -> LogInfo:
@@ -93,7 +344,7 @@ def parse_log_info(data: tp.List[str]) -> LogInfo:
     result.remote_addr = next(iter_data)
     result.remote_user = next(iter_data)
     result.http_x_real_ip = next(iter_data)
-    result.time_local = time.strptime(next(iter_data), "[%d/%b/%Y:%H:%M:%S %z]")
+    result.time_local_raw = next(iter_data).strip("[]")
     result.request = next(iter_data)
     result.status = next(iter_data)
     result.body_bytes_sent = next(iter_data)
@@ -103,23 +354,218 @@ def parse_log_info(data: tp.List[str]) -> LogInfo:
     result.http_X_REQUEST_ID = next(iter_data)
     result.http_X_RB_USER = next(iter_data)
     result.request_time = float(next(iter_data))
+    assert math.isfinite(result.request_time)
     return result
 
 
-def process_log_info(reader: tp.Generator[tp.List[str], None, None]) -> tp.Tuple[tp.Dict[str, StatInfo], int]:
+def parse_log_line(line: str) -> LogInfo:
+    """Полный разбор строки ui_short одним проходом скомпилированного шаблона"""
+    match = UI_SHORT_RE.match(line)
+    if match is None:
+        raise ValueError(f"line does not match ui_short log_format: {line!r}")
+    result = LogInfo()
+    for name, value in match.groupdict().items():
+        setattr(result, name, value)
+    result.request_time = float(match.group("request_time"))
+    if not math.isfinite(result.request_time):
+        raise ValueError(f"$request_time is not a finite number: {line!r}")
+    return result
+
+
+UI_SHORT_QUOTES = 12  # в log_format ui_short шесть полей в кавычках
+
+
+def parse_request_fields(line: str) -> tp.Tuple[str, float]:
+    """Быстрый разбор строки ui_short: достает только url из $request и $request_time,
+    остальные поля не декодируются. Структура строки проверяется по числу кавычек, так что
+    обрезанная строка не даст вместо $request_time, например, $body_bytes_sent"""
+    if line.count('"') != UI_SHORT_QUOTES:
+        raise ValueError(f"line does not match ui_short log_format: {line!r}")
+    start = line.index('"') + 1
+    end = line.index('"', start)
+    tail = line.rindex('"') + 1
+    request_time = float(line[tail:])
+    if line[tail] != " " or not math.isfinite(request_time):
+        raise ValueError(f"bad $request_time after the last quoted field: {line[tail:]!r}")
+    return request_url(line[start:end]), request_time
+
+
+def time_of_day_seconds(time_local: str) -> int:
+    """Секунды от начала местных суток для $time_local вида 29/Jun/2017:03:50:22 +0300.
+    Формат фиксированный, поэтому поля берутся срезами по позициям, без strptime"""
+    if len(time_local) != 26 or time_local[11] != ":" or time_local[14] != ":" or time_local[17] != ":":
+        raise ValueError(f"bad $time_local {time_local!r}")
+    return int(time_local[12:14]) * 3600 + int(time_local[15:17]) * 60 + int(time_local[18:20])
+
+
+def parse_request_fields_timed(line: str) -> tp.Tuple[str, float, int]:
+    """Как parse_request_fields (с той же проверкой структуры), но еще отдает секунды от начала суток по $time_local"""
+    if line.count('"') != UI_SHORT_QUOTES:
+        raise ValueError(f"line does not match ui_short log_format: {line!r}")
+    time_start = line.index("[") + 1
+    start = line.index('"', time_start) + 1
+    end = line.index('"', start)
+    tail = line.rindex('"') + 1
+    request_time = float(line[tail:])
+    if line[tail] != " " or not math.isfinite(request_time):
+        raise ValueError(f"bad $request_time after the last quoted field: {line[tail:]!r}")
+    return (
+        request_url(line[start:end]),
+        request_time,
+        time_of_day_seconds(line[time_start:line.index("]", time_start)]),
+    )
+
+
+def parse_request_fields_legacy(line: str) -> tp.Tuple[str, float]:
+    """Прежний разбор строки через log_line_split и parse_log_info, оставлен для сравнения"""
+    log_info = parse_log_info(log_line_split(line))
+    return log_info.request_clear(), log_info.request_time
+
+
+ERROR_BUDGET_MIN_LINES = 1000  # раньше этого числа строк доля ошибок не оценивается
+ERROR_BUDGET_Z = 3.0  # квантиль нормального распределения для нижней границы доли ошибок (~99.9%)
+ERROR_SAMPLE_FIRST = 10  # сколько первых ошибочных строк выводится в лог
+ERROR_SAMPLE_EVERY = 1000  # дальше выводится каждая такая по счету ошибочная строка
+
+
+class ErrorBudgetExceeded(Exception):
+    pass
+
+
+def error_ratio_lower_bound(error_count: int, line_count: int, z: float = ERROR_BUDGET_Z) -> float:
+    """Нижняя граница доверительного интервала Уилсона для доли ошибочных строк"""
+    if line_count == 0:
+        return 0.0
+    ratio = error_count / line_count
+    z2 = z * z
+    center = ratio + z2 / (2 * line_count)
+    spread = z * math.sqrt(ratio * (1 - ratio) / line_count + z2 / (4 * line_count * line_count))
+    return max(0.0, (center - spread) / (1 + z2 / line_count))
+
+
+class ErrorBudget:
+    """Учет ошибочных строк по ходу чтения: выборочный вывод в лог, счетчики по видам ошибок
+    и досрочная остановка, когда доля ошибок уже наверняка превышает max_ratio.
+    lines и errors - строки и ошибки, учтенные раньше (например, в контрольной точке).
+    С log_errors=False ошибочные строки только считаются - для повторных проходов по уже проверенному логу"""
+
+    def __init__(self, max_ratio: tp.Optional[float] = None, lines: int = 0, errors: int = 0, log_errors: bool = True):
+        self.max_ratio = max_ratio
+        self.base_lines = lines
+        self.base_errors = errors
+        self.log_errors = log_errors
+        self.error_count = 0
+        self.categories = collections.Counter()
+
+    def on_error(self, exc: Exception, line: tp.Union[str, bytes], line_number: int) -> None:
+        self.error_count += 1
+        category = type(exc).__name__
+        self.categories[category] += 1
+        if self.log_errors and (self.error_count <= ERROR_SAMPLE_FIRST or self.error_count % ERROR_SAMPLE_EVERY == 0):
+            logging.error(f"bad line {line_number} (error {self.error_count}): {category}: {exc}; {line[:200]!r}")
+        if self.max_ratio is None:
+            return
+        lines = self.base_lines + line_number
+        errors = self.base_errors + self.error_count
+        if lines >= ERROR_BUDGET_MIN_LINES and error_ratio_lower_bound(errors, lines) > self.max_ratio:
+            raise ErrorBudgetExceeded(
+                f"{errors} of {lines} lines are bad, error ratio is certainly above {self.max_ratio}"
+            )
+
+    def log_summary(self) -> None:
+        if self.log_errors and self.error_count > 0:
+            summary = ", ".join(f"{category}: {count}" for category, count in self.categories.most_common())
+            logging.warning(f"{self.error_count} bad lines ({summary})")
+
+
+def process_log_info(
+        reader: tp.Iterable[str],
+        line_parser: tp.Callable[[str], tp.Tuple[str, float]] = parse_request_fields,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        error_budget: tp.Optional[ErrorBudget] = None,
+        percentiles: bool = False,
+) -> tp.Tuple[tp.Dict[str, StatInfo], int]:
     request_2_log_info = {}
-    error_count = 0
-    for info in reader:
+    if error_budget is None:
+        error_budget = ErrorBudget()
+    normalize = url_normalizer.normalize if url_normalizer is not None else None
+    for line_number, line in enumerate(reader, 1):
+        try:
+            request, request_time = line_parser(line)
+            if normalize is not None:
+                request = normalize(request)
+            sat_info = request_2_log_info.get(request)
+            if sat_info is None:
+                sat_info = request_2_log_info[request] = StatInfo(request, sketch=percentiles)
+            sat_info.append_time(request_time)
+        except Exception as exc:
+            error_budget.on_error(exc, line, line_number)
+    error_budget.log_summary()
+    return request_2_log_info, error_budget.error_count
+
+
+AGGREGATION_BACKENDS = ("python", "numpy")
+
+
+def resolve_aggregation_backend(backend: str) -> str:
+    if backend not in AGGREGATION_BACKENDS:
+        raise ValueError(f"AGGREGATION_BACKEND must be one of {', '.join(AGGREGATION_BACKENDS)}, got {backend!r}")
+    if backend == "numpy" and np is None:
+        logging.warning("numpy is not installed, python aggregation backend is used")
+        return "python"
+    return backend
+
+
+def process_log_info_numpy(
+        reader: tp.Iterable[str],
+        line_parser: tp.Callable[[str], tp.Tuple[str, float]] = parse_request_fields,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        error_budget: tp.Optional[ErrorBudget] = None,
+) -> tp.Tuple[tp.Dict[str, StatInfo], int]:
+    """То же, что process_log_info, но вместо StatInfo на каждую строку копятся два плоских массива:
+    номер url и время запроса. count и sum считаются через np.bincount (суммирование идет в порядке строк,
+    поэтому суммы совпадают до бита), max и медиана - по одной сортировке np.lexsort по (url, время)
+    и индексам начала отрезков url. Агрегаты возвращаются замороженными, без времен запросов"""
+    url_ids = {}
+    ids = array.array("i")
+    times = array.array("d")
+    if error_budget is None:
+        error_budget = ErrorBudget()
+    normalize = url_normalizer.normalize if url_normalizer is not None else None
+    for line_number, line in enumerate(reader, 1):
         try:
-            log_info = parse_log_info(info)
-            request = log_info.request_clear()
-            sat_info = request_2_log_info[request] if request_2_log_info.get(request, False) else StatInfo(request)
-            sat_info.append_time(log_info.request_time)
-            request_2_log_info[request] = sat_info
+            request, request_time = line_parser(line)
+            if normalize is not None:
+                request = normalize(request)
+            url_id = url_ids.get(request)
+            if url_id is None:
+                url_id = url_ids[request] = len(url_ids)
+            ids.append(url_id)
+            times.append(request_time)
         except Exception as exc:
-            logging.exception(exc.args)
-            error_count += 1
-    return request_2_log_info, error_count
+            error_budget.on_error(exc, line, line_number)
+    error_budget.log_summary()
+    if len(url_ids) == 0:
+        return {}, error_budget.error_count
+    id_array = np.frombuffer(ids, dtype=np.intc)
+    time_array = np.frombuffer(times, dtype=np.float64)
+    counts = np.bincount(id_array, minlength=len(url_ids))
+    sums = np.bincount(id_array, weights=time_array, minlength=len(url_ids))
+    sorted_times = time_array[np.lexsort((time_array, id_array))]
+    starts = np.cumsum(counts) - counts
+    maxes = sorted_times[starts + counts - 1]
+    middles = starts + counts // 2
+    medians = np.where(
+        counts % 2 == 1,
+        sorted_times[middles],
+        0.5 * (sorted_times[middles] + sorted_times[middles - 1]),
+    )
+    result = {}
+    for request, count, time_sum, time_max, median in zip(
+            url_ids, counts.tolist(), sums.tolist(), maxes.tolist(), medians.tolist()
+    ):
+        result[request] = StatInfo.from_aggregate(request, count, time_sum, time_max, median)
+    return result, error_budget.error_count
 
 
 def log_line_split(s: str) -> tp.List[str]:
@@ -127,85 +573,1917 @@ def log_line_split(s: str) -> tp.List[str]:
     return [part.replace("\x00", " ").replace('"', '') for part in parts]
 
 
-def _read_log(log_name: str) -> tp.Generator[tp.List[str], None, None]:
-    reader = gzip.open if log_name.lower().endswith(".gz") else open
+GZIP_READ_BLOCK = 1 << 20  # размер блока сжатых данных, читаемого за раз
+GZIP_QUEUE_SIZE = 8  # сколько пачек строк может ждать разбора, ограничивает память конвейера
+
+
+def _gzip_line_batches(log_name: str, block_size: int = GZIP_READ_BLOCK) -> tp.Generator[bytes, None, None]:
+    """Распаковывает gzip большими блоками (zlib отпускает GIL) и отдает пачки целых строк"""
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    tail = b""
+    with open(log_name, mode="rb") as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            data = b""
+            while block:
+                if decompressor.eof:  # следующий gzip member, нулевое выравнивание перед ним пропускаем как gzip
+                    block = block.lstrip(b"\x00")
+                    if not block:
+                        break
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                data += decompressor.decompress(block)
+                block = decompressor.unused_data
+            end = data.rfind(b"\n")
+            if end < 0:
+                tail += data
+                continue
+            yield tail + data[:end]
+            tail = data[end + 1:]
+    if not decompressor.eof:
+        raise EOFError(f"compressed file {log_name} ended before the end-of-stream marker was reached")
+    if tail:
+        yield tail
+
+
+def _read_gzip_log(log_name: str, queue_size: int = GZIP_QUEUE_SIZE) -> tp.Generator[str, None, None]:
+    """Конвейер: отдельный поток распаковывает лог и кладет пачки строк в ограниченную очередь,
+    разбор идет в вызывающем потоке. Заполненная очередь притормаживает распаковку"""
+    batches = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item: tp.Any) -> bool:
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for batch in _gzip_line_batches(log_name):
+                if not put(batch):
+                    return
+        except BaseException as exc:
+            put(exc)
+        else:
+            put(None)
+
+    producer = threading.Thread(target=produce, name="gzip-reader", daemon=True)
+    producer.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, BaseException):
+                raise batch
+            yield from map(str.rstrip, batch.decode("utf8").split("\n"))
+    finally:
+        stop.set()
+        producer.join()
+
+
+def _read_log(log_name: str) -> tp.Generator[str, None, None]:
+    is_gzip = log_name.lower().endswith(".gz")
+    if is_gzip and (os.cpu_count() or 1) > 1:  # на одном ядре конвейер только добавляет переключения потоков
+        yield from _read_gzip_log(log_name)
+        return
+    reader = gzip.open if is_gzip else open
     with reader(log_name, mode="rt", encoding="utf8") as file:
         for line in file:
-            yield log_line_split(line.rstrip())
+            yield line.rstrip()
+
+
+def _shard_offsets(log_name: str, shards: int, size: tp.Optional[int] = None) -> tp.List[tp.Tuple[int, int]]:
+    """Делит первые size байт файла на участки [start, end), границы которых выровнены на начало строки"""
+    if size is None:
+        size = os.path.getsize(log_name)
+    offsets = [0]
+    with open(log_name, mode="rb") as file:
+        for idx in range(1, shards):
+            position = max(size * idx // shards, offsets[-1])
+            if position >= size:
+                break
+            if position > 0:
+                file.seek(position - 1)
+                file.readline()  # дочитываем строку, в середину которой попала граница
+                position = file.tell()
+            offsets.append(position)
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
+
+
+MMAP_CHUNK_SIZE = 1 << 22  # сколько байт отображенного файла режется на строки за раз
+MMAP_URL_CACHE_SIZE = 100000  # сколько разных $request помнит MmapLogReader без нормализатора
+
+
+class MmapLogReader:
+    """Читает несжатый лог (или его участок [start, end)) через mmap без декодирования строк.
+    Итерация отдает строки как bytes, parse_request_fields достает из них только url и $request_time.
+    Url декодируется (и с url_normalizer нормализуется) один раз на каждый новый $request, дальше берется
+    из кэша bytes -> str. Кэш ограничен размером кэша нормализатора или MMAP_URL_CACHE_SIZE и при переполнении
+    очищается, так что память не растет с числом разных url. Url отдаются уже нормализованными, повторно
+    передавать url_normalizer в process_log_info не нужно"""
+
+    def __init__(
+            self,
+            log_name: str,
+            start: int = 0,
+            end: tp.Optional[int] = None,
+            url_normalizer: tp.Optional[UrlNormalizer] = None,
+    ):
+        self._file = open(log_name, mode="rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b""
+        self._start = start
+        self._end = size if end is None else min(end, size)
+        self._urls = {}
+        self._normalize = url_normalizer.normalize if url_normalizer is not None else sys.intern
+        self._cache_size = url_normalizer.cache_size if url_normalizer is not None else MMAP_URL_CACHE_SIZE
 
+    def __enter__(self) -> "MmapLogReader":
+        return self
 
-def calculate_stat_info(stat_info: tp.Dict[str, StatInfo]) -> tp.List[dict]:
+    def __exit__(self, *exc_info: tp.Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+    def __iter__(self) -> tp.Generator[bytes, None, None]:
+        data = self._mmap
+        position = self._start
+        end = self._end
+        while position < end:
+            chunk_end = min(position + MMAP_CHUNK_SIZE, end)
+            if chunk_end < end:
+                line_end = data.rfind(b"\n", position, chunk_end)
+                chunk_end = line_end + 1 if line_end >= position else chunk_end
+            lines = data[position:chunk_end].split(b"\n")
+            if data[chunk_end - 1:chunk_end] == b"\n":
+                lines.pop()
+            position = chunk_end
+            yield from lines
+
+    def parse_request_fields(self, line: bytes) -> tp.Tuple[str, float]:
+        """Та же проверка структуры, что в parse_request_fields для str"""
+        line = line.rstrip()
+        if line.count(b'"') != UI_SHORT_QUOTES:
+            raise ValueError(f"line does not match ui_short log_format: {line!r}")
+        request_start = line.index(b'"') + 1
+        request_end = line.index(b'"', request_start)
+        tail = line.rindex(b'"') + 1
+        request_time = float(line[tail:])
+        if line[tail:tail + 1] != b" " or not math.isfinite(request_time):
+            raise ValueError(f"bad $request_time after the last quoted field: {line[tail:]!r}")
+        request = line[request_start:request_end]
+        url = self._urls.get(request)
+        if url is None:
+            if len(self._urls) >= self._cache_size:
+                self._urls.clear()
+            url = self._urls[request] = self._normalize(request_url(request.decode("utf8")))
+        return url, request_time
+
+
+def _process_log_range(
+        log_name: str,
+        start: int,
+        end: int,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        error_budget: tp.Optional[ErrorBudget] = None,
+        percentiles: bool = False,
+) -> tp.Tuple[tp.Dict[str, StatInfo], int]:
+    with MmapLogReader(log_name, start, end, url_normalizer) as reader:
+        return process_log_info(reader, reader.parse_request_fields, error_budget=error_budget, percentiles=percentiles)
+
+
+def merge_stat_info(target: tp.Dict[str, StatInfo], source: tp.Dict[str, StatInfo]) -> None:
+    for request, info in source.items():
+        exist_info = target.get(request)
+        if exist_info is None:
+            target[request] = info
+        else:
+            exist_info.merge(info)
+
+
+def process_log_info_parallel(
+        log_name: str,
+        workers: int,
+        size: tp.Optional[int] = None,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        percentiles: bool = False,
+        max_error_ratio: tp.Optional[float] = None,
+) -> tp.Tuple[tp.Dict[str, StatInfo], int]:
+    """Разбирает несжатый лог по участкам в пуле процессов. Участки сливаются в порядке следования
+    в файле, поэтому результат совпадает с последовательным process_log_info.
+    У каждого участка свой ErrorBudget: ошибочные строки выборочно выводятся в лог (номера строк - от начала
+    участка), и с max_error_ratio участок останавливается досрочно. Сумма по готовым участкам проверяется
+    по мере их завершения, ErrorBudgetExceeded отменяет еще не начатые участки"""
+    shards = _shard_offsets(log_name, workers, size)
+    shard_results = [None] * len(shards)
+    line_count = 0
+    error_count = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                _process_log_range, log_name, start, end, url_normalizer, ErrorBudget(max_error_ratio), percentiles
+            ): idx
+            for idx, (start, end) in enumerate(shards)
+        }
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                shard_info, shard_error_count = shard_results[futures[future]] = future.result()
+                line_count += sum(info.count() for info in shard_info.values()) + shard_error_count
+                error_count += shard_error_count
+                if (max_error_ratio is not None and line_count >= ERROR_BUDGET_MIN_LINES
+                        and error_ratio_lower_bound(error_count, line_count) > max_error_ratio):
+                    raise ErrorBudgetExceeded(
+                        f"{error_count} of {line_count} lines are bad, error ratio is certainly above {max_error_ratio}"
+                    )
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    result = {}
+    for shard_info, _ in shard_results:
+        merge_stat_info(result, shard_info)
+    return result, error_count
+
+
+REPORT_PERCENTILES = (90, 95, 99)
+
+
+def calculate_stat_info(stat_info: tp.Dict[str, StatInfo], report_size: int = 0) -> tp.List[dict]:
+    """Строки репорта, отсортированные по убыванию time_perc. При report_size > 0 url сначала
+    отбираются по сумме времени через кучу, а медиана и строка считаются только для попавших в репорт.
+    Для агрегатов со скетчами добавляются колонки time_p90, time_p95, time_p99"""
     all_count = 0
     all_time = 0
     for info in stat_info.values():
         all_count += info.count()
         all_time += info.request_times_sum()
 
+    def by_time_sum(item: tp.Tuple[str, StatInfo]) -> float:
+        return item[1].request_times_sum()
+
+    # сортируем по сумме времени без округления: иначе url с time_perc, равным после округления до 3 знаков,
+    # шли бы в порядке появления в логе, и в обрезанный репорт мог не попасть более тяжелый из них.
+    # nlargest и sorted устойчивы: при равной сумме времени url идут в порядке появления в логе
+    if 0 < report_size < len(stat_info):
+        top_items = heapq.nlargest(report_size, stat_info.items(), key=by_time_sum)
+    else:
+        top_items = sorted(stat_info.items(), key=by_time_sum, reverse=True)
+
     result = []
 
-    for request, info in stat_info.items():
+    for request, info in top_items:
+        count = info.count()
+        time_sum = info.request_times_sum()
         row_table = {
             "url": request,
-            "count": info.count(),
-            "count_perc": round(float(info.count()) / all_count, 3),
-            "time_sum": round(info.request_times_sum(), 3),
-            "time_perc": round(info.request_times_sum() / all_time, 3),
-            "time_avg": round(info.request_times_avg(), 3),
+            "count": count,
+            "count_perc": round(float(count) / all_count, 3),
+            "time_sum": round(time_sum, 3),
+            "time_perc": round(time_sum / all_time, 3),
+            "time_avg": round(time_sum / count, 3),
             "time_max": round(info.request_times_max(), 3),
             "time_med": round(info.request_times_median(), 3),
         }
+        sketch = info.sketch()
+        if sketch is not None:
+            for percent in REPORT_PERCENTILES:
+                row_table[f"time_p{percent}"] = round(sketch.quantile(percent / 100.0), 3)
         result.append(row_table)
 
     return result
 
 
-def process_log_file(log_name: str) -> tp.Tuple[tp.List[dict], int]:
-    log_info, error_count = process_log_info(_read_log(log_name))
-    stat_info = calculate_stat_info(log_info)
-    stat_info.sort(key=lambda x: x["time_perc"], reverse=True)
+TIME_BUCKETS = {"1m": 60, "5m": 300, "1h": 3600}
+
+
+class TimeSeries:
+    """Агрегаты по url и интервалам местных суток. Для каждого url в общих плоских массивах
+    выделяется по ячейке на интервал (1440 для "1m", 288 для "5m", 24 для "1h") под число запросов,
+    сумму и максимум времени, так что память пропорциональна числу url на число интервалов
+    (поэтому в build_report ряды ведутся только для url, попавших в таблицу).
+    Лог - за одни сутки, поэтому дата в интервал не входит"""
+
+    __slots__ = ("bucket_seconds", "bucket_count", "_url_ids", "_counts", "_sums", "_maxes")
+
+    def __init__(self, bucket_seconds: int):
+        if bucket_seconds <= 0 or 86400 % bucket_seconds != 0:
+            raise ValueError(f"bucket of {bucket_seconds} seconds does not divide a day")
+        self.bucket_seconds = bucket_seconds
+        self.bucket_count = 86400 // bucket_seconds
+        self._url_ids = {}
+        self._counts = array.array("q")
+        self._sums = array.array("d")
+        self._maxes = array.array("d")
+
+    def _url_base(self, url: str) -> int:
+        url_id = self._url_ids.get(url)
+        if url_id is None:
+            url_id = self._url_ids[url] = len(self._url_ids)
+            self._counts.extend(array.array("q", bytes(8 * self.bucket_count)))
+            self._sums.extend(array.array("d", bytes(8 * self.bucket_count)))
+            self._maxes.extend(array.array("d", bytes(8 * self.bucket_count)))
+        return url_id * self.bucket_count
+
+    def append_time(self, url: str, seconds: int, request_time: float) -> None:
+        cell = self._url_base(url) + seconds // self.bucket_seconds
+        self._counts[cell] += 1
+        self._sums[cell] += request_time
+        if request_time > self._maxes[cell]:
+            self._maxes[cell] = request_time
+
+    def urls(self) -> tp.List[str]:
+        return list(self._url_ids)
+
+    def bucket_start(self, bucket: int) -> str:
+        seconds = bucket * self.bucket_seconds
+        return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}"
+
+    def rows(self, urls: tp.Iterable[str]) -> tp.Generator[dict, None, None]:
+        """Строки таблицы по непустым интервалам заданных url, в порядке url и времени"""
+        for url in urls:
+            url_id = self._url_ids.get(url)
+            if url_id is None:
+                continue
+            base = url_id * self.bucket_count
+            for bucket in range(self.bucket_count):
+                count = self._counts[base + bucket]
+                if count == 0:
+                    continue
+                time_sum = self._sums[base + bucket]
+                yield {
+                    "url": url,
+                    "bucket": self.bucket_start(bucket),
+                    "count": count,
+                    "time_sum": round(time_sum, 3),
+                    "time_avg": round(time_sum / count, 3),
+                    "time_max": round(self._maxes[base + bucket], 3),
+                }
+
+
+def process_time_series(
+        reader: tp.Iterable[str],
+        bucket_seconds: int,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        error_budget: tp.Optional[ErrorBudget] = None,
+        urls: tp.Optional[tp.Iterable[str]] = None,
+) -> tp.Tuple[TimeSeries, int]:
+    """Агрегаты лога по url и интервалам суток. С urls ряды ведутся только для этих url,
+    остальные строки разбираются, но ячеек под них не выделяется"""
+    time_series = TimeSeries(bucket_seconds)
+    wanted = set(urls) if urls is not None else None
+    if error_budget is None:
+        error_budget = ErrorBudget()
+    normalize = url_normalizer.normalize if url_normalizer is not None else None
+    for line_number, line in enumerate(reader, 1):
+        try:
+            request, request_time, seconds = parse_request_fields_timed(line)
+            if normalize is not None:
+                request = normalize(request)
+            if wanted is None or request in wanted:
+                time_series.append_time(request, seconds, request_time)
+        except Exception as exc:
+            error_budget.on_error(exc, line, line_number)
+    error_budget.log_summary()
+    return time_series, error_budget.error_count
+
+
+TIME_SERIES_FIELDS = ("url", "bucket", "count", "time_sum", "time_avg", "time_max")
+
+
+def time_series_file_path(html_save: str) -> str:
+    return f"{os.path.splitext(html_save)[0]}.timeseries.csv"
+
+
+def save_time_series_table(table_path: str, time_series: TimeSeries, urls: tp.Iterable[str]) -> None:
+    os.makedirs(os.path.dirname(table_path) or ".", exist_ok=True)
+    temp_path = f"{table_path}.tmp"
+    with open(temp_path, mode="w", encoding="utf8", newline="") as file:
+        writer = csv.DictWriter(file, TIME_SERIES_FIELDS)
+        writer.writeheader()
+        writer.writerows(time_series.rows(urls))
+    os.replace(temp_path, table_path)
+
+
+CHECKPOINT_VERSION = 3
+CHECKPOINT_HEAD_SIZE = 4096  # по crc начала файла отличаем перезаписанный на месте лог (copytruncate)
+
+
+def _file_identity(log_name: str, head_size: int, stat: tp.Optional[os.stat_result] = None) -> tp.Dict[str, tp.Any]:
+    if stat is None:
+        stat = os.stat(log_name)
+    with open(log_name, mode="rb") as file:
+        head = file.read(head_size)
+    return {
+        "inode": stat.st_ino,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "head_size": len(head),
+        "head_crc": zlib.crc32(head),
+    }
+
+
+def load_checkpoint(checkpoint_path: str, with_stat_info: bool = True) -> tp.Optional[tp.Dict[str, tp.Any]]:
+    """Контрольная точка - два pickle подряд: небольшой заголовок (версия, смещение, число ошибок,
+    отпечаток лога) и агрегаты по url. Без with_stat_info читается только заголовок"""
+    try:
+        with open(checkpoint_path, mode="rb") as file:
+            checkpoint = pickle.load(file)
+            is_known = isinstance(checkpoint, dict) and checkpoint.get("version") == CHECKPOINT_VERSION
+            if is_known and with_stat_info:
+                checkpoint["stat_info"] = pickle.load(file)
+    except FileNotFoundError:
+        return None
+    except Exception as exc:
+        logging.warning(f"checkpoint {checkpoint_path} is unreadable, ignored: {exc}")
+        return None
+    if not is_known:
+        logging.warning(f"checkpoint {checkpoint_path} has unknown version, ignored")
+        return None
+    return checkpoint
+
+
+def save_checkpoint(checkpoint_path: str, checkpoint: tp.Dict[str, tp.Any]) -> None:
+    os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+    temp_path = f"{checkpoint_path}.tmp"
+    header = {key: value for key, value in checkpoint.items() if key != "stat_info"}
+    with open(temp_path, mode="wb") as file:
+        pickle.dump(header, file, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(checkpoint["stat_info"], file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, checkpoint_path)
+
+
+def checkpoint_resume_offset(log_name: str, checkpoint: tp.Optional[tp.Dict[str, tp.Any]]) -> int:
+    """Смещение, с которого можно продолжить разбор, или 0, если лог ротирован или обрезан"""
+    if checkpoint is None:
+        return 0
+    identity = _file_identity(log_name, checkpoint["head_size"])
+    if identity["inode"] != checkpoint["inode"]:
+        logging.info(f"{log_name} was rotated, full parse")
+        return 0
+    if identity["size"] < checkpoint["offset"] or identity["head_crc"] != checkpoint["head_crc"]:
+        logging.info(f"{log_name} was truncated or rewritten, full parse")
+        return 0
+    return checkpoint["offset"]
+
+
+def is_checkpoint_current(log_name: str, checkpoint_path: str) -> bool:
+    """True, если с момента сохранения контрольной точки лог не менялся. Агрегаты не загружаются"""
+    checkpoint = load_checkpoint(checkpoint_path, with_stat_info=False)
+    if checkpoint is None:
+        return False
+    stat = os.stat(log_name)
+    identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    return identity == (checkpoint["inode"], checkpoint["size"], checkpoint["mtime"])
+
+
+def _last_line_end(log_name: str, start: int, size: int) -> int:
+    """Конец последней полной строки: недописанный хвост растущего лога оставляем на следующий запуск"""
+    with open(log_name, mode="rb") as file:
+        position = size
+        while position > start:
+            block_start = max(start, position - MMAP_CHUNK_SIZE)
+            file.seek(block_start)
+            line_end = file.read(position - block_start).rfind(b"\n")
+            if line_end >= 0:
+                return block_start + line_end + 1
+            position = block_start
+    return start
+
+
+def process_log_info_incremental(
+        log_name: str,
+        checkpoint_path: str,
+        workers: int = 1,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        max_error_ratio: tp.Optional[float] = None,
+        percentiles: bool = False,
+        metrics: tp.Optional["Metrics"] = None,
+) -> tp.Tuple[tp.Dict[str, StatInfo], int]:
+    """Продолжает разбор несжатого лога с сохраненного смещения и обновляет контрольную точку.
+    В metrics записывается, сколько строк и байт разобрано в этот раз"""
+    checkpoint = load_checkpoint(checkpoint_path, with_stat_info=False)
+    offset = checkpoint_resume_offset(log_name, checkpoint)
+    if offset > 0:  # агрегаты нужны, только если лог дочитывается, а не разбирается заново
+        checkpoint = load_checkpoint(checkpoint_path)
+        offset = checkpoint["offset"] if checkpoint is not None else 0
+    if offset > 0:
+        log_info, error_count = checkpoint["stat_info"], checkpoint["error_count"]
+        logging.info(f"resume {log_name} from offset {offset}")
+    else:
+        log_info, error_count = {}, 0
+    stat = os.stat(log_name)
+    end = _last_line_end(log_name, offset, stat.st_size)
+    parsed_lines = 0
+    if end > offset:
+        if offset == 0 and workers > 1:
+            new_info, new_error_count = process_log_info_parallel(
+                log_name, workers, end, url_normalizer, percentiles, max_error_ratio
+            )
+        else:
+            error_budget = ErrorBudget(
+                max_error_ratio, sum(info.count() for info in log_info.values()) + error_count, error_count
+            )
+            new_info, new_error_count = _process_log_range(
+                log_name, offset, end, url_normalizer, error_budget, percentiles
+            )
+        parsed_lines = sum(info.count() for info in new_info.values()) + new_error_count
+        merge_stat_info(log_info, new_info)
+        error_count += new_error_count
+    if metrics is not None:
+        metrics.counters.update({"parsed_lines": parsed_lines, "parsed_bytes": end - offset})
+    head_size = checkpoint["head_size"] if offset > 0 else min(CHECKPOINT_HEAD_SIZE, end)
+    identity = _file_identity(log_name, head_size, stat)
+    save_checkpoint(checkpoint_path, {
+        "version": CHECKPOINT_VERSION,
+        "offset": end,
+        "error_count": error_count,
+        "stat_info": log_info,
+        **identity,
+    })
+    return log_info, error_count
+
+
+AGGREGATE_MAGIC = b"LAGG"
+AGGREGATE_VERSION = 2
+# magic, версия, размер лога, mtime лога в нс, inode лога, число ошибочных строк, число url,
+# общее число корзин скетчей (-1 - агрегаты без скетчей)
+AGGREGATE_HEADER = struct.Struct("<4sHqqqqqq")
+
+
+def save_aggregate_cache(
+        cache_path: str,
+        log_name: str,
+        stat_info: tp.Dict[str, StatInfo],
+        error_count: int,
+        stat: tp.Optional[os.stat_result] = None,
+) -> None:
+    """Пишет замороженные агрегаты лога колонками: url, count, time_sum, time_max, time_med, а если у всех
+    агрегатов есть скетчи - еще число нулевых времен и корзин каждого скетча и сами корзины подряд.
+    stat - состояние лога на момент начала разбора, по нему кэш потом проверяется на актуальность"""
+    if stat is None:
+        stat = os.stat(log_name)
+    urls = array.array("q", [0])
+    url_blob = bytearray()
+    counts = array.array("q")
+    sums = array.array("d")
+    maxes = array.array("d")
+    medians = array.array("d")
+    has_sketches = len(stat_info) > 0 and all(info.sketch() is not None for info in stat_info.values())
+    sketch_zeros = array.array("q")
+    sketch_lengths = array.array("q")
+    bin_indexes = array.array("q")
+    bin_counts = array.array("q")
+    for request, info in stat_info.items():
+        url_blob += request.encode("utf8")
+        urls.append(len(url_blob))
+        counts.append(info.count())
+        sums.append(info.request_times_sum())
+        maxes.append(info.request_times_max())
+        medians.append(info.request_times_median())
+        if has_sketches:
+            sketch = info.sketch()
+            bins = sketch.bins()
+            sketch_zeros.append(sketch.zero_count())
+            sketch_lengths.append(len(bins))
+            bin_indexes.extend(index for index, _ in bins)
+            bin_counts.extend(count for _, count in bins)
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    temp_path = f"{cache_path}.tmp"
+    with open(temp_path, mode="wb") as file:
+        file.write(AGGREGATE_HEADER.pack(
+            AGGREGATE_MAGIC,
+            AGGREGATE_VERSION,
+            stat.st_size,
+            stat.st_mtime_ns,
+            stat.st_ino,
+            error_count,
+            len(counts),
+            len(bin_indexes) if has_sketches else -1,
+        ))
+        file.write(struct.pack("<q", len(url_blob)))
+        file.write(url_blob)
+        for column in (urls, counts, sums, maxes, medians, sketch_zeros, sketch_lengths, bin_indexes, bin_counts):
+            column.tofile(file)
+    os.replace(temp_path, cache_path)
+
+
+def load_aggregate_cache(cache_path: str, log_name: str) -> tp.Optional[tp.Tuple[tp.Dict[str, StatInfo], int]]:
+    """Читает агрегаты лога из кэша, если кэш есть и лог с тех пор не менялся"""
+    try:
+        with open(cache_path, mode="rb") as file:
+            magic, version, size, mtime, inode, error_count, url_count, bin_count = AGGREGATE_HEADER.unpack(
+                file.read(AGGREGATE_HEADER.size)
+            )
+            if magic != AGGREGATE_MAGIC or version != AGGREGATE_VERSION:
+                logging.info(f"aggregate cache {cache_path} has unknown format, ignored")
+                return None
+            stat = os.stat(log_name)
+            if (size, mtime, inode) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                logging.info(f"log {log_name} was changed since aggregate cache was written, ignored")
+                return None
+            (blob_size,) = struct.unpack("<q", file.read(8))
+            url_blob = file.read(blob_size)
+            layout = [("q", url_count + 1), ("q", url_count), ("d", url_count), ("d", url_count), ("d", url_count)]
+            if bin_count >= 0:
+                layout += [("q", url_count), ("q", url_count), ("q", bin_count), ("q", bin_count)]
+            columns = []
+            for typecode, length in layout:
+                column = array.array(typecode)
+                column.fromfile(file, length)
+                columns.append(column)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, struct.error) as exc:
+        logging.warning(f"aggregate cache {cache_path} is unreadable, ignored: {exc}")
+        return None
+    urls, counts, sums, maxes, medians = columns[:5]
+    stat_info = {}
+    bin_start = 0
+    for idx in range(url_count):
+        request = url_blob[urls[idx]:urls[idx + 1]].decode("utf8")
+        sketch = None
+        if bin_count >= 0:
+            sketch_zeros, sketch_lengths, bin_indexes, bin_counts = columns[5:]
+            bin_end = bin_start + sketch_lengths[idx]
+            sketch = QuantileSketch.from_bins(
+                sketch_zeros[idx], zip(bin_indexes[bin_start:bin_end], bin_counts[bin_start:bin_end])
+            )
+            bin_start = bin_end
+        stat_info[request] = StatInfo.from_aggregate(
+            request, counts[idx], sums[idx], maxes[idx], medians[idx], sketch
+        )
     return stat_info, error_count
 
 
-def create_html_file(html_save: str, stat_info: tp.List[dict]) -> None:
-    html_txt = pathlib.Path('report.html').read_text().replace("$table_json", str(stat_info))
+def aggregate_log_file(
+        log_name: str,
+        *,
+        workers: int = 1,
+        checkpoint_path: tp.Optional[str] = None,
+        cache_path: tp.Optional[str] = None,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        max_error_ratio: tp.Optional[float] = None,
+        percentiles: bool = False,
+        backend: str = "python",
+        metrics: tp.Optional["Metrics"] = None,
+) -> tp.Tuple[tp.Dict[str, StatInfo], int]:
+    """Агрегаты лога по url и число ошибочных строк. С max_error_ratio разбор (и последовательный, и по участкам)
+    останавливается исключением ErrorBudgetExceeded, как только доля ошибок наверняка его превышает.
+    С percentiles в агрегатах ведутся скетчи для перцентилей. Backend "numpy" используется только
+    для последовательного разбора без скетчей: агрегаты участков и контрольных точек должны сливаться.
+    В metrics записывается, сколько строк и байт лога действительно разобрано (из кэша - ноль)"""
+    is_gzip = log_name.lower().endswith(".gz")
+    use_numpy = backend == "numpy" and np is not None and not percentiles
+    log_stat = os.stat(log_name)
+    cached = load_aggregate_cache(cache_path, log_name) if cache_path is not None else None
+    if cached is not None:
+        log_info, error_count = cached
+    elif checkpoint_path is not None and not is_gzip:
+        log_info, error_count = process_log_info_incremental(
+            log_name, checkpoint_path, workers, url_normalizer, max_error_ratio, percentiles, metrics
+        )
+    elif workers > 1 and not is_gzip:
+        log_info, error_count = process_log_info_parallel(
+            log_name, workers, url_normalizer=url_normalizer, percentiles=percentiles, max_error_ratio=max_error_ratio
+        )
+    elif not is_gzip and use_numpy:
+        with MmapLogReader(log_name, url_normalizer=url_normalizer) as reader:
+            log_info, error_count = process_log_info_numpy(
+                reader, reader.parse_request_fields, error_budget=ErrorBudget(max_error_ratio)
+            )
+    elif not is_gzip:
+        log_info, error_count = _process_log_range(
+            log_name, 0, os.path.getsize(log_name), url_normalizer, ErrorBudget(max_error_ratio), percentiles
+        )
+    elif use_numpy:
+        log_info, error_count = process_log_info_numpy(
+            _read_log(log_name), url_normalizer=url_normalizer, error_budget=ErrorBudget(max_error_ratio)
+        )
+    else:
+        log_info, error_count = process_log_info(
+            _read_log(log_name),
+            url_normalizer=url_normalizer,
+            error_budget=ErrorBudget(max_error_ratio),
+            percentiles=percentiles,
+        )
+    if metrics is not None and cached is not None:
+        metrics.counters.update({"parsed_lines": 0, "parsed_bytes": 0})
+    elif metrics is not None and "parsed_lines" not in metrics.counters:  # не дочитывали с контрольной точки
+        metrics.counters.update({
+            "parsed_lines": sum(info.count() for info in log_info.values()) + error_count,
+            "parsed_bytes": log_stat.st_size,
+        })
+    if cache_path is not None and cached is None:
+        for info in log_info.values():
+            info.freeze()
+        save_aggregate_cache(cache_path, log_name, log_info, error_count, log_stat)
+    return log_info, error_count
+
+
+def process_log_file(
+        log_name: str,
+        *,
+        workers: int = 1,
+        checkpoint_path: tp.Optional[str] = None,
+        cache_path: tp.Optional[str] = None,
+        report_size: int = 0,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        percentiles: bool = False,
+        backend: str = "python",
+) -> tp.Tuple[tp.List[dict], int]:
+    log_info, error_count = aggregate_log_file(
+        log_name,
+        workers=workers,
+        checkpoint_path=checkpoint_path,
+        cache_path=cache_path,
+        url_normalizer=url_normalizer,
+        percentiles=percentiles,
+        backend=backend,
+    )
+    return calculate_stat_info(log_info, report_size), error_count
+
+
+class Metrics:
+    """Замеры стадий одного прогона (время, процессорное время с учетом дочерних процессов)
+    и счетчики, сохраняются в JSON рядом с репортом. Стоимость - пара системных вызовов на стадию"""
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self._started = time.perf_counter()
+
+    @staticmethod
+    def _cpu_time() -> float:
+        times = os.times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> tp.Generator[None, None, None]:
+        wall_started = time.perf_counter()
+        cpu_started = self._cpu_time()
+        try:
+            yield
+        finally:
+            self.stages[name] = {
+                "wall_seconds": round(time.perf_counter() - wall_started, 6),
+                "cpu_seconds": round(self._cpu_time() - cpu_started, 6),
+            }
+
+    @staticmethod
+    def peak_memory_mb() -> tp.Optional[float]:
+        if resource is None:
+            return None
+        scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # ru_maxrss в байтах на macOS, иначе в КБ
+        peak = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        )
+        return round(peak / scale, 1)
+
+    def to_dict(self) -> tp.Dict[str, tp.Any]:
+        result = {
+            "wall_seconds": round(time.perf_counter() - self._started, 6),
+            "peak_memory_mb": self.peak_memory_mb(),
+            "stages": self.stages,
+            **self.counters,
+        }
+        aggregate = self.stages.get("aggregate")
+        if aggregate and aggregate["wall_seconds"] > 0 and self.counters.get("parsed_lines"):
+            # только то, что разобрано в этом прогоне: агрегаты из кэша и контрольной точки не в счет
+            result["lines_per_sec"] = round(self.counters["parsed_lines"] / aggregate["wall_seconds"])
+            if "parsed_bytes" in self.counters:
+                result["bytes_per_sec"] = round(self.counters["parsed_bytes"] / aggregate["wall_seconds"])
+        return result
+
+    def save(self, metrics_path: str) -> None:
+        os.makedirs(os.path.dirname(metrics_path) or ".", exist_ok=True)
+        temp_path = f"{metrics_path}.tmp"
+        with open(temp_path, mode="w") as file:
+            json.dump(self.to_dict(), file, indent=2)
+        os.replace(temp_path, metrics_path)
+
+
+def measure(metrics: tp.Optional[Metrics], name: str) -> tp.ContextManager[None]:
+    return metrics.stage(name) if metrics is not None else contextlib.nullcontext()
+
+
+def metrics_file_path(html_save: str) -> str:
+    return f"{os.path.splitext(html_save)[0]}.metrics.json"
+
+
+REPORT_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "report.html")
+REPORT_WRITE_BUFFER = 1 << 20
+
+
+@functools.lru_cache(maxsize=None)
+def _load_report_template(template_path: str) -> tp.Tuple[str, str]:
+    """Шаблон репорта читается и делится по $table_json один раз за процесс"""
+    head, table_mark, tail = pathlib.Path(template_path).read_text().partition("$table_json")
+    if not table_mark:
+        raise ValueError(f"report template {template_path} has no $table_json placeholder")
+    return head, tail
+
+
+def create_html_file(
+        html_save: str,
+        stat_info: tp.Iterable[dict],
+        template_path: str = REPORT_TEMPLATE,
+        caption: str = "",
+) -> None:
+    """Пишет строки репорта в шаблон потоком, как JSON-массив, через буферизованную запись во временный файл,
+    который затем атомарно переименовывается: недописанный репорт никогда не появляется под своим именем.
+    caption подставляется в шаблон вместо $caption (подпись над таблицей), если такой метки нет - не выводится"""
+    head, tail = _load_report_template(template_path)
+    head = head.replace("$caption", html.escape(caption))
     path = pathlib.Path(html_save)
     os.makedirs(path.parent.as_posix(), exist_ok=True)
-    path.write_text(html_txt)
+    temp_path = f"{html_save}.tmp"
+    try:
+        with open(temp_path, mode="w", encoding="utf8", buffering=REPORT_WRITE_BUFFER) as file:
+            file.write(head)
+            file.write("[")
+            for idx, row in enumerate(stat_info):
+                if idx > 0:
+                    file.write(",\n")
+                file.write(json.dumps(row, ensure_ascii=False).replace("</", "<\\/"))  # не закрываем <script>
+            file.write("]")
+            file.write(tail)
+        os.replace(temp_path, html_save)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 
-def provide_last_log_path_and_date(log_folder: str) -> tp.Tuple[tp.Optional[str], tp.Optional[str]]:
-    reg_mask = r'nginx-access-ui.log-(\d{2})(\d{2})(\d{4})($|.gz)'
-    files = sorted(
-        [
-            file for file in os.listdir(log_folder)
-            if os.path.isfile(os.path.join(log_folder, file)) and re.match(reg_mask, file)
-        ],
-        reverse=True
-    )
-    if len(files) == 0:
+LOG_NAME_MASK = re.compile(r'nginx-access-ui\.log-(\d{2})(\d{2})(\d{4})(\.gz)?$')
+LOG_INDEX_VERSION = 1
+LOG_INDEX_RACY_NS = 2 * 10 ** 9  # индексу, записанному вскоре после изменения папки, не доверяем (грубый mtime)
+
+
+class LogFile(tp.NamedTuple):
+    name: str
+    date: datetime.date
+
+
+def parse_log_name(name: str) -> tp.Optional[datetime.date]:
+    """Дата лога из имени nginx-access-ui.log-DDMMYYYY[.gz] или None, если имя не подходит"""
+    match = LOG_NAME_MASK.match(name)
+    if match is None:
+        return None
+    day, month, year = match.group(1, 2, 3)
+    try:
+        return datetime.date(int(year), int(month), int(day))
+    except ValueError:
+        return None
+
+
+def _load_log_index(index_path: str, log_folder: str, folder_mtime: int) -> tp.Optional[tp.List[LogFile]]:
+    try:
+        with open(index_path) as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if index.get("version") != LOG_INDEX_VERSION or index.get("log_folder") != os.path.abspath(log_folder):
+        return None
+    if index.get("mtime") != folder_mtime or index.get("saved_at", 0) - folder_mtime < LOG_INDEX_RACY_NS:
+        return None
+    return [LogFile(name, datetime.date.fromisoformat(date)) for name, date in index["logs"]]
+
+
+def _save_log_index(index_path: str, log_folder: str, folder_mtime: int, logs: tp.List[LogFile]) -> None:
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    temp_path = f"{index_path}.tmp"
+    with open(temp_path, mode="w") as file:
+        json.dump({
+            "version": LOG_INDEX_VERSION,
+            "log_folder": os.path.abspath(log_folder),
+            "mtime": folder_mtime,
+            "saved_at": time.time_ns(),
+            "logs": [[log.name, log.date.isoformat()] for log in logs],
+        }, file)
+    os.replace(temp_path, index_path)
+
+
+def scan_log_folder(log_folder: str, index_path: tp.Optional[str] = None) -> tp.List[LogFile]:
+    """Логи папки с датами. Используется os.scandir, тип записи берется из d_type без лишних stat.
+    С index_path список запоминается вместе с mtime папки и, пока в папке не добавлялись
+    и не удалялись файлы, повторно не собирается"""
+    folder_mtime = os.stat(log_folder).st_mtime_ns
+    if index_path is not None:
+        logs = _load_log_index(index_path, log_folder, folder_mtime)
+        if logs is not None:
+            return logs
+    logs = []
+    with os.scandir(log_folder) as entries:
+        for entry in entries:
+            date = parse_log_name(entry.name)
+            if date is not None and entry.is_file():
+                logs.append(LogFile(entry.name, date))
+    if index_path is not None:
+        _save_log_index(index_path, log_folder, folder_mtime, logs)
+    return logs
+
+
+def report_date_str(date: datetime.date) -> str:
+    return date.strftime("%Y.%m.%d")
+
+
+def provide_last_log_path_and_date(
+        log_folder: str,
+        index_path: tp.Optional[str] = None,
+) -> tp.Tuple[tp.Optional[str], tp.Optional[str]]:
+    logs = scan_log_folder(log_folder, index_path)
+    if len(logs) == 0:
         return None, None
-    log_name = files[0]
-    date_str = re.search(reg_mask, log_name).group(0)
-    return log_name, date_str
+    log = max(logs, key=lambda x: (x.date, x.name))
+    return log.name, report_date_str(log.date)
+
+
+def provide_all_logs_and_dates(log_folder: str, index_path: tp.Optional[str] = None) -> tp.List[tp.Tuple[str, str]]:
+    logs = sorted(scan_log_folder(log_folder, index_path), key=lambda x: (x.date, x.name))
+    return [(log.name, report_date_str(log.date)) for log in logs]
+
+
+# url_stats хранится в порядке (url, дата): сводка за период по url идет одним проходом без сортировки,
+# а индекс (дата, url) нужен для перезаписи одного дня и коротких периодов
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS url_stats (
+    url_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    time_sum REAL NOT NULL,
+    time_max REAL NOT NULL,
+    time_med REAL NOT NULL,
+    time_p90 REAL,
+    time_p95 REAL,
+    time_p99 REAL,
+    PRIMARY KEY (url_id, date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS url_stats_date_url ON url_stats (date, url_id);
+CREATE TABLE IF NOT EXISTS days (
+    date TEXT PRIMARY KEY,
+    log TEXT NOT NULL,
+    lines INTEGER NOT NULL,
+    errors INTEGER NOT NULL
+);
+"""
+HISTORY_BUSY_TIMEOUT = 60  # секунд ждать, пока базу пишет другой процесс (например, в режиме --backfill)
+
+
+def _connect_history(db_path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    connection = sqlite3.connect(db_path, timeout=HISTORY_BUSY_TIMEOUT)
+    connection.executescript(HISTORY_SCHEMA)
+    return connection
+
+
+def save_history(
+        db_path: str,
+        date: datetime.date,
+        log_name: str,
+        stat_info: tp.Dict[str, StatInfo],
+        error_count: int,
+) -> None:
+    """Пишет агрегаты всех url лога за день в SQLite одной транзакцией: прежние строки этой даты удаляются
+    и вставляются заново через executemany, поэтому повторный разбор того же дня ничего не дублирует"""
+    rows = []
+    for request, info in stat_info.items():
+        sketch = info.sketch()
+        percentiles = [sketch.quantile(percent / 100.0) if sketch is not None else None
+                       for percent in REPORT_PERCENTILES]
+        rows.append((
+            date.isoformat(),
+            info.count(),
+            info.request_times_sum(),
+            info.request_times_max(),
+            info.request_times_median(),
+            *percentiles,
+            request,
+        ))
+    line_count = sum(info.count() for info in stat_info.values()) + error_count
+    connection = _connect_history(db_path)
+    try:
+        with connection:
+            connection.execute("DELETE FROM url_stats WHERE date = ?", (date.isoformat(),))
+            connection.executemany("INSERT OR IGNORE INTO urls (url) VALUES (?)", ((row[-1],) for row in rows))
+            connection.executemany(
+                "INSERT INTO url_stats SELECT id, ?, ?, ?, ?, ?, ?, ?, ? FROM urls WHERE url = ?", rows
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?)", (date.isoformat(), log_name, line_count, error_count)
+            )
+    finally:
+        connection.close()
+
+
+def history_report_rows(
+        db_path: str,
+        date_from: datetime.date,
+        date_to: datetime.date,
+        report_size: int = 0,
+) -> tp.List[dict]:
+    """Строки репорта за несколько дней прямо из базы, без разбора логов. count, time_sum и time_max
+    сводятся точно, а медиана и перцентили за период из дневных значений не выводятся, поэтому для них
+    берется худший день: колонки time_med_max, time_p90_max и т.д."""
+    connection = _connect_history(db_path)
+    try:
+        period = (date_from.isoformat(), date_to.isoformat())
+        (stored_days,) = connection.execute("SELECT COUNT(*) FROM days").fetchone()
+        # короткий период дешевле найти по индексу дат, а длинный - пройти таблицу в порядке url,
+        # тогда группировка не требует сортировки (+date запрещает sqlite выбирать индекс)
+        date_column = "date" if ((date_to - date_from).days + 1) * 4 < stored_days else "+date"
+        # url подставляется уже после группировки, по разу на url, а не на каждую дневную строку
+        totals = connection.execute(
+            "SELECT url_id, url, count, time_sum, time_max, time_med, time_p90, time_p95, time_p99 FROM ("
+            "SELECT url_id, SUM(count) AS count, SUM(time_sum) AS time_sum, MAX(time_max) AS time_max, "
+            "MAX(time_med) AS time_med, MAX(time_p90) AS time_p90, MAX(time_p95) AS time_p95, "
+            f"MAX(time_p99) AS time_p99 FROM url_stats WHERE {date_column} BETWEEN ? AND ? GROUP BY url_id"
+            ") JOIN urls ON urls.id = url_id",
+            period,
+        ).fetchall()
+        all_count = sum(total[2] for total in totals)
+        all_time = sum(total[3] for total in totals)
+        if all_count == 0:
+            return []
+        # при равной сумме времени url идут в порядке первого сохранения
+        if 0 < report_size < len(totals):
+            totals = heapq.nlargest(report_size, totals, key=lambda total: (total[3], -total[0]))
+        else:
+            totals.sort(key=lambda total: (-total[3], total[0]))
+        result = []
+        for _, url, count, time_sum, time_max, time_med, *percentiles in totals:
+            row_table = {
+                "url": url,
+                "count": count,
+                "count_perc": round(float(count) / all_count, 3),
+                "time_sum": round(time_sum, 3),
+                "time_perc": round(time_sum / all_time, 3) if all_time > 0 else 0.0,
+                "time_avg": round(time_sum / count, 3),
+                "time_max": round(time_max, 3),
+                "time_med_max": round(time_med, 3),
+            }
+            for percent, value in zip(REPORT_PERCENTILES, percentiles):
+                if value is not None:
+                    row_table[f"time_p{percent}_max"] = round(value, 3)
+            result.append(row_table)
+        return result
+    finally:
+        connection.close()
+
+
+def history_trend(db_path: str, url: str, date_from: datetime.date, date_to: datetime.date) -> tp.List[dict]:
+    """Дневные агрегаты одного url за период, по возрастанию даты"""
+    connection = _connect_history(db_path)
+    connection.row_factory = sqlite3.Row
+    try:
+        rows = connection.execute(
+            "SELECT date, url, count, time_sum, time_max, time_med, time_p90, time_p95, time_p99 "
+            "FROM url_stats JOIN urls ON urls.id = url_stats.url_id WHERE url = ? AND date BETWEEN ? AND ? "
+            "ORDER BY date",
+            (url, date_from.isoformat(), date_to.isoformat()),
+        )
+        return [{key: row[key] for key in row.keys() if row[key] is not None} for row in rows]
+    finally:
+        connection.close()
+
+
+def build_history_report(
+        db_path: str,
+        report_folder: str,
+        date_from: datetime.date,
+        date_to: datetime.date,
+        report_size: int = 0,
+) -> tp.Optional[str]:
+    """Пишет репорт report-<с>-<по>.html за период из базы истории, None - за период в базе ничего нет"""
+    rows = history_report_rows(db_path, date_from, date_to, report_size)
+    if len(rows) == 0:
+        return None
+    html_save = os.path.join(report_folder, f"report-{report_date_str(date_from)}-{report_date_str(date_to)}.html")
+    create_html_file(html_save, rows)
+    return html_save
+
+
+def history_dates(db_path: str) -> tp.Set[datetime.date]:
+    connection = _connect_history(db_path)
+    try:
+        return {datetime.date.fromisoformat(date) for (date,) in connection.execute("SELECT date FROM days")}
+    finally:
+        connection.close()
+
 
+def fill_history(
+        db_path: str,
+        log_folder: str,
+        dates: tp.Iterable[datetime.date],
+        max_error_ratio: float,
+        *,
+        cache_folder: tp.Optional[str] = None,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        index_path: tp.Optional[str] = None,
+        percentiles: bool = False,
+) -> tp.List[datetime.date]:
+    """Дописывает в базу истории дни, которых в ней нет, из логов log_folder (через кэш агрегатов,
+    если он есть). С percentiles, как в build_report, пишутся и колонки перцентилей, чтобы дописанные
+    дни не отличались от записанных обычным запуском. Возвращает дни, которых нет ни в базе, ни среди логов"""
+    stored = history_dates(db_path)
+    missing = [date for date in dates if date not in stored]
+    if len(missing) == 0:
+        return []
+    logs = {}
+    for log in sorted(scan_log_folder(log_folder, index_path), key=lambda x: x.name):
+        logs[log.date] = log.name
+    unknown = []
+    for date in missing:
+        log_name = logs.get(date)
+        if log_name is None:
+            unknown.append(date)
+            continue
+        log_info, error_count = aggregate_log_file(
+            os.path.join(log_folder, log_name),
+            cache_path=aggregate_cache_path(cache_folder, log_name, url_normalizer, percentiles),
+            url_normalizer=url_normalizer,
+            max_error_ratio=max_error_ratio,
+            percentiles=percentiles,
+        )
+        save_history(db_path, date, log_name, log_info, error_count)
+        logging.info(f"{log_name} was added to history")
+    return unknown
 
-def process_folder(log_folder: str, report_folder: str, max_error_ratio: float, report_size: int = 0) -> None:
-    log_name, date_str = provide_last_log_path_and_date(log_folder)
+
+def _ratio(value: float, base: float) -> tp.Optional[float]:
+    return round(value / base, 3) if base > 0 else None
+
+
+def regression_rows(
+        db_path: str,
+        dates: tp.List[datetime.date],
+        thresholds: tp.Optional[tp.Dict[str, float]] = None,
+        report_size: int = 0,
+) -> tp.List[dict]:
+    """Сравнивает последний из dates день с предыдущими по агрегатам из базы истории и возвращает
+    url, у которых time_sum, time_avg или time_med выросли больше порогов, по убыванию прироста time_sum.
+    База - средние по предыдущим дням: time_sum и count на день (день без запросов считается нулем),
+    time_avg по всем их запросам, time_med - среднее дневных медиан. Соединение по url - хэш: в памяти
+    только словарь id url -> агрегаты базовых дней, строки последнего дня читаются курсором,
+    а отобранные держатся в куче размера report_size. Новые url попадают в репорт без отношений"""
+    if thresholds is None:
+        thresholds = default_config["REGRESSION_THRESHOLDS"]
+    *base_dates, date = dates
+    if len(base_dates) == 0:
+        raise ValueError("at least two days are needed for comparison")
+    min_count = thresholds.get("min_count", 0)
+    connection = _connect_history(db_path)
+    try:
+        baseline = {}
+        for base_date in base_dates:
+            for url_id, count, time_sum, time_med in connection.execute(
+                    "SELECT url_id, count, time_sum, time_med FROM url_stats WHERE date = ?", (base_date.isoformat(),)
+            ):
+                total = baseline.get(url_id)
+                if total is None:
+                    baseline[url_id] = [count, time_sum, time_med, 1]
+                else:
+                    total[0] += count
+                    total[1] += time_sum
+                    total[2] += time_med
+                    total[3] += 1
+        selected = []
+        rows = connection.execute(
+            "SELECT url_id, url, count, time_sum, time_med FROM url_stats JOIN urls ON urls.id = url_stats.url_id "
+            "WHERE date = ?",
+            (date.isoformat(),),
+        )
+        for order, (url_id, url, count, time_sum, time_med) in enumerate(rows):
+            if count < min_count:
+                continue
+            time_avg = time_sum / count
+            base_count, base_sum, base_med, base_days = baseline.get(url_id, (0, 0.0, 0.0, 0))
+            base_sum /= len(base_dates)
+            base_avg = base_sum * len(base_dates) / base_count if base_count > 0 else 0.0
+            base_med = base_med / base_days if base_days > 0 else 0.0
+            row_table = {
+                "url": url,
+                "count": count,
+                "count_base": round(base_count / len(base_dates), 1),
+                "time_sum": round(time_sum, 3),
+                "time_sum_base": round(base_sum, 3),
+                "time_sum_delta": round(time_sum - base_sum, 3),
+                "time_sum_ratio": _ratio(time_sum, base_sum),
+                "time_avg": round(time_avg, 3),
+                "time_avg_base": round(base_avg, 3),
+                "time_avg_ratio": _ratio(time_avg, base_avg),
+                "time_med": round(time_med, 3),
+                "time_med_base": round(base_med, 3),
+                "time_med_ratio": _ratio(time_med, base_med),
+            }
+            is_regression = base_days == 0 or any(
+                row_table[f"{metric}_ratio"] is not None and row_table[f"{metric}_ratio"] > thresholds[metric]
+                for metric in ("time_sum", "time_avg", "time_med")
+                if metric in thresholds
+            )
+            if not is_regression:
+                continue
+            item = (time_sum - base_sum, -order, row_table)
+            if report_size <= 0:
+                selected.append(item)
+            elif len(selected) < report_size:
+                heapq.heappush(selected, item)
+            elif item > selected[0]:
+                heapq.heapreplace(selected, item)
+        return [row_table for _, _, row_table in sorted(selected, reverse=True)]
+    finally:
+        connection.close()
+
+
+def build_regression_report(
+        db_path: str,
+        report_folder: str,
+        dates: tp.List[datetime.date],
+        thresholds: tp.Optional[tp.Dict[str, float]] = None,
+        report_size: int = 0,
+) -> str:
+    """Пишет репорт регрессий regression-<последний день>.html через тот же макет report.html"""
+    rows = regression_rows(db_path, dates, thresholds, report_size)
+    html_save = os.path.join(report_folder, f"regression-{report_date_str(dates[-1])}.html")
+    create_html_file(html_save, rows)
+    return html_save
+
+
+def _save_log_history(
+        history_db: str,
+        log_path: str,
+        log_info: tp.Dict[str, StatInfo],
+        error_count: int,
+        metrics: tp.Optional[Metrics] = None,
+) -> None:
+    log_name = os.path.basename(log_path)
+    date = parse_log_name(log_name)
+    if date is None:
+        logging.warning(f"date of {log_name} is unknown, aggregates were not saved to history")
+        return
+    with measure(metrics, "history"):
+        save_history(history_db, date, log_name, log_info, error_count)
+
+
+def build_report(
+        log_path: str,
+        html_save: str,
+        max_error_ratio: float,
+        report_size: int = 0,
+        *,
+        workers: int = 1,
+        checkpoint_path: tp.Optional[str] = None,
+        cache_path: tp.Optional[str] = None,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        metrics: tp.Optional[Metrics] = None,
+        time_bucket: tp.Optional[str] = None,
+        time_series_top: int = 20,
+        percentiles: bool = False,
+        backend: str = "python",
+        history_db: tp.Optional[str] = None,
+) -> tp.Tuple[bool, str]:
+    """Разбирает лог и пишет репорт. Возвращает признак записи репорта и описание результата.
+    Если передан metrics, рядом с репортом сохраняются замеры стадий. С time_bucket вторым проходом
+    по логу считаются агрегаты по интервалам суток для time_series_top первых url репорта,
+    и рядом с ним пишется таблица report-<дата>.timeseries.csv (кэш агрегатов интервалов не хранит,
+    так что этот проход нужен и при агрегатах из кэша или контрольной точки). Ошибочные строки уже учтены
+    первым проходом, во втором они не выводятся в лог повторно. С percentiles в репорте есть колонки
+    time_p90, time_p95, time_p99. backend - способ агрегации, см. aggregate_log_file. С history_db агрегаты
+    всех url за день (дата - из имени лога) сохраняются в базу истории"""
+    try:
+        with measure(metrics, "aggregate"):
+            log_info, error_count = aggregate_log_file(
+                log_path,
+                workers=workers,
+                checkpoint_path=checkpoint_path,
+                cache_path=cache_path,
+                url_normalizer=url_normalizer,
+                max_error_ratio=max_error_ratio,
+                percentiles=percentiles,
+                backend=backend,
+                metrics=metrics,
+            )
+    except ErrorBudgetExceeded as exc:
+        if metrics is not None:
+            metrics.counters.update({"log": log_path, "aborted": str(exc)})
+            metrics.save(metrics_file_path(html_save))
+        return False, f"report file has too many error({exc}), parsing was stopped early"
+    line_count = sum(info.count() for info in log_info.values()) + error_count
+    if metrics is not None:
+        metrics.counters.update({
+            "log": log_path,
+            "bytes": os.path.getsize(log_path),
+            "lines": line_count,
+            "error_count": error_count,
+            "url_count": len(log_info),
+        })
+    try:
+        if line_count == 0:
+            return False, "log file is empty"
+        error_ratio = float(error_count) / line_count
+        if error_ratio > max_error_ratio:
+            return False, f"report file has too many error(error_ratio is {error_ratio}, limit is {max_error_ratio}"
+        with measure(metrics, "stats"):
+            stat_info = calculate_stat_info(log_info, report_size)
+        with measure(metrics, "render"):
+            create_html_file(html_save, stat_info)
+        if time_bucket is not None:
+            with measure(metrics, "timeseries"):
+                top_urls = [row["url"] for row in stat_info[:time_series_top]]
+                time_series, _ = process_time_series(
+                    _read_log(log_path),
+                    TIME_BUCKETS[time_bucket],
+                    url_normalizer,
+                    error_budget=ErrorBudget(log_errors=False),
+                    urls=top_urls,
+                )
+                save_time_series_table(time_series_file_path(html_save), time_series, top_urls)
+        if history_db is not None:
+            _save_log_history(history_db, log_path, log_info, error_count, metrics)
+        return True, f"report {html_save} was created"
+    finally:
+        if metrics is not None:
+            metrics.save(metrics_file_path(html_save))
+
+
+def _state_file_path(
+        folder: tp.Optional[str],
+        log_name: str,
+        suffix: str,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        percentiles: bool = False,
+) -> tp.Optional[str]:
+    """Путь к файлу состояния лога (кэш, контрольная точка). Агрегаты с разными правилами
+    нормализации url несовместимы, поэтому отпечаток правил входит в имя файла.
+    Агрегаты со скетчами перцентилей хранятся отдельно от агрегатов без них"""
+    if folder is None:
+        return None
+    if percentiles:
+        suffix = f"pct.{suffix}"
+    if url_normalizer is not None:
+        suffix = f"{url_normalizer.fingerprint:08x}.{suffix}"
+    return os.path.join(folder, f"{log_name}.{suffix}")
+
+
+def aggregate_cache_path(
+        cache_folder: tp.Optional[str],
+        log_name: str,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        percentiles: bool = False,
+) -> tp.Optional[str]:
+    return _state_file_path(cache_folder, log_name, "agg", url_normalizer, percentiles)
+
+
+def process_folder(
+        log_folder: str,
+        report_folder: str,
+        max_error_ratio: float,
+        report_size: int = 0,
+        *,
+        workers: int = 1,
+        checkpoint_folder: tp.Optional[str] = None,
+        cache_folder: tp.Optional[str] = None,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        write_metrics: bool = False,
+        index_path: tp.Optional[str] = None,
+        time_bucket: tp.Optional[str] = None,
+        time_series_top: int = 20,
+        percentiles: bool = False,
+        backend: str = "python",
+        history_db: tp.Optional[str] = None,
+) -> None:
+    metrics = Metrics() if write_metrics else None
+    with measure(metrics, "discovery"):
+        log_name, date_str = provide_last_log_path_and_date(log_folder, index_path)
     if log_name is None or date_str is None:
         logging.info("No log file to work, exit")
         return
     html_save = os.path.join(report_folder, f"report-{date_str}.html")
+    log_path = os.path.join(log_folder, log_name)
+    checkpoint_path = None
+    if not log_name.lower().endswith(".gz"):
+        checkpoint_path = _state_file_path(checkpoint_folder, log_name, "checkpoint", url_normalizer, percentiles)
+    if os.path.exists(html_save):
+        if checkpoint_path is None or not os.path.exists(checkpoint_path):
+            logging.info("report file to log already exists, working was canceled, exit")
+            return
+        if is_checkpoint_current(log_path, checkpoint_path):
+            logging.info("log was not changed since last report, exit")
+            return
+    cache_path = aggregate_cache_path(cache_folder, log_name, url_normalizer, percentiles)
+    is_created, message = build_report(
+        log_path,
+        html_save,
+        max_error_ratio,
+        report_size=report_size,
+        workers=workers,
+        checkpoint_path=checkpoint_path,
+        cache_path=cache_path,
+        url_normalizer=url_normalizer,
+        metrics=metrics,
+        time_bucket=time_bucket,
+        time_series_top=time_series_top,
+        percentiles=percentiles,
+        backend=backend,
+        history_db=history_db,
+    )
+    if not is_created:
+        logging.error(f"{message}, exit")
+
+
+class SourceSummary(tp.NamedTuple):
+    source: str
+    log: tp.Optional[str]
+    status: str  # ok, missing, failed, too many errors
+    lines: int = 0
+    errors: int = 0
+    message: str = ""
+
+
+def sources_file_path(html_save: str) -> str:
+    return f"{os.path.splitext(html_save)[0]}.sources.json"
+
+
+def save_sources_summary(sources_path: str, summary: tp.Dict[str, SourceSummary]) -> None:
+    os.makedirs(os.path.dirname(sources_path) or ".", exist_ok=True)
+    temp_path = f"{sources_path}.tmp"
+    with open(temp_path, mode="w") as file:
+        json.dump([source._asdict() for source in summary.values()], file, indent=2)
+    os.replace(temp_path, sources_path)
+
+
+def sources_caption(summary: tp.Dict[str, SourceSummary]) -> str:
+    """Подпись к репорту: статус, число строк и ошибок каждого источника, по строке на источник"""
+    return "\n".join(
+        f"{source.source}: {source.status}, {source.lines} lines, {source.errors} errors" for source in summary.values()
+    )
+
+
+def find_source_logs(log_folders: tp.List[str]) -> tp.Tuple[tp.Optional[datetime.date], tp.Dict[str, tp.Any]]:
+    """Самая свежая дата среди логов всех папок и лог этой даты в каждой папке (None - лога нет,
+    исключение - папку не удалось прочитать)"""
+    folder_logs = {}
+    for log_folder in log_folders:
+        try:
+            folder_logs[log_folder] = scan_log_folder(log_folder)
+        except OSError as exc:
+            folder_logs[log_folder] = exc
+    dates = [log.date for logs in folder_logs.values() if not isinstance(logs, Exception) for log in logs]
+    if len(dates) == 0:
+        return None, folder_logs
+    date = max(dates)
+    source_logs = {}
+    for log_folder, logs in folder_logs.items():
+        if isinstance(logs, Exception):
+            source_logs[log_folder] = logs
+        else:
+            names = [log.name for log in logs if log.date == date]
+            source_logs[log_folder] = max(names) if names else None
+    return date, source_logs
+
+
+# ключи конфига, которые не действуют при LOG_DIR списком: логи источников всегда разбираются целиком,
+# без кэша, контрольных точек, индекса папки, таблицы по интервалам и numpy
+MULTI_SOURCE_IGNORED_KEYS = (
+    "CACHE_DIR", "CHECKPOINT_DIR", "LOG_INDEX_FILE", "TIME_BUCKET", "TIME_SERIES_TOP_URLS", "AGGREGATION_BACKEND"
+)
+
+
+def multi_source_ignored_keys(config: tp.Dict[str, tp.Any]) -> tp.List[str]:
+    """Ключи из MULTI_SOURCE_IGNORED_KEYS, заданные в конфиге не по умолчанию"""
+    return [key for key in MULTI_SOURCE_IGNORED_KEYS if config.get(key, default_config[key]) != default_config[key]]
+
+
+async def _aggregate_sources(
+        log_paths: tp.List[str],
+        executor: concurrent.futures.Executor,
+        max_error_ratio: float,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        percentiles: bool = False,
+) -> tp.List[tp.Any]:
+    """Агрегирует логи источников одновременно: пока один ждет диска или распаковки, разбирается другой.
+    Результат - агрегаты или исключение по каждому логу, в порядке log_paths"""
+    loop = asyncio.get_running_loop()
+    tasks = [
+        loop.run_in_executor(executor, functools.partial(
+            aggregate_log_file,
+            log_path,
+            url_normalizer=url_normalizer,
+            max_error_ratio=max_error_ratio,
+            percentiles=percentiles,
+        ))
+        for log_path in log_paths
+    ]
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def process_sources(
+        log_folders: tp.List[str],
+        report_folder: str,
+        max_error_ratio: float,
+        report_size: int = 0,
+        *,
+        workers: int = 1,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        write_metrics: bool = False,
+        percentiles: bool = False,
+        history_db: tp.Optional[str] = None,
+) -> tp.Dict[str, SourceSummary]:
+    """Один репорт по логам одного дня с нескольких хостов, каждый из которых пишет логи в свою папку.
+    Логи читаются одновременно в потоках (workers > 1 - в процессах), агрегаты сливаются в порядке
+    папок. Папка без лога за этот день, нечитаемая или с избытком ошибок попадает в итог со своим
+    статусом, а репорт строится по остальным. Итог по источникам выводится в подписи к репорту
+    и пишется в report-<дата>.sources.json, даже если ни один источник не подошел и репорта нет"""
+    metrics = Metrics() if write_metrics else None
+    with measure(metrics, "discovery"):
+        date, source_logs = find_source_logs(log_folders)
+    if date is None:
+        logging.info("No log file to work in any source, exit")
+        return {}
+    html_save = os.path.join(report_folder, f"report-{report_date_str(date)}.html")
     if os.path.exists(html_save):
         logging.info("report file to log already exists, working was canceled, exit")
-        return
-    stat_info, error_count = process_log_file(os.path.join(log_folder, log_name))
-    error_ratio = float(error_count) / len(stat_info)
-    if error_ratio > max_error_ratio:
-        logging.error(f"report file has too many error(error_ratio is {error_ratio}, limit is {max_error_ratio}, exit")
-        return
-    if report_size > 0:
-        stat_info = stat_info[:min(len(stat_info), report_size)]
-    create_html_file(html_save, stat_info)
+        return {}
+    summary = {}
+    jobs = {}
+    for log_folder, log_name in source_logs.items():
+        if isinstance(log_name, Exception):
+            summary[log_folder] = SourceSummary(log_folder, None, "missing", message=str(log_name))
+        elif log_name is None:
+            summary[log_folder] = SourceSummary(log_folder, None, "missing", message=f"no log for {date}")
+        else:
+            jobs[log_folder] = log_name
+    log_info = {}
+    with measure(metrics, "aggregate"):
+        results = []
+        if len(jobs) > 0:
+            if workers > 1:
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(jobs)))
+            else:  # чтение и распаковка gzip отпускают GIL, потоков достаточно, чтобы они шли одновременно
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs))
+            with executor:
+                results = asyncio.run(_aggregate_sources(
+                    [os.path.join(log_folder, log_name) for log_folder, log_name in jobs.items()],
+                    executor,
+                    max_error_ratio,
+                    url_normalizer,
+                    percentiles,
+                ))
+        for (log_folder, log_name), result in zip(jobs.items(), results):
+            if isinstance(result, ErrorBudgetExceeded):
+                summary[log_folder] = SourceSummary(log_folder, log_name, "too many errors", message=str(result))
+                continue
+            if isinstance(result, Exception):
+                summary[log_folder] = SourceSummary(log_folder, log_name, "failed", message=repr(result))
+                continue
+            source_info, error_count = result
+            line_count = sum(info.count() for info in source_info.values()) + error_count
+            if line_count == 0 or float(error_count) / line_count > max_error_ratio:
+                summary[log_folder] = SourceSummary(
+                    log_folder, log_name, "too many errors", line_count, error_count, "log is empty or corrupt"
+                )
+                continue
+            summary[log_folder] = SourceSummary(log_folder, log_name, "ok", line_count, error_count)
+            merge_stat_info(log_info, source_info)
+    summary = {log_folder: summary[log_folder] for log_folder in log_folders}
+    for source in summary.values():
+        message = f" ({source.message})" if source.message else ""
+        log = logging.info if source.status == "ok" else logging.error
+        log(f"source {source.source}: {source.status}, {source.lines} lines, {source.errors} errors{message}")
+    save_sources_summary(sources_file_path(html_save), summary)
+    if len(log_info) > 0:
+        with measure(metrics, "stats"):
+            stat_info = calculate_stat_info(log_info, report_size)
+        with measure(metrics, "render"):
+            create_html_file(html_save, stat_info, caption=sources_caption(summary))
+        if history_db is not None:
+            error_count = sum(source.errors for source in summary.values() if source.status == "ok")
+            sources = ",".join(f"{source.source}/{source.log}" for source in summary.values() if source.status == "ok")
+            with measure(metrics, "history"):
+                save_history(history_db, date, sources, log_info, error_count)
+        logging.info(f"report {html_save} was created from {sum(s.status == 'ok' for s in summary.values())} sources")
+    else:
+        logging.error("no source has a usable log, report was not created")
+    if metrics is not None:
+        line_count = sum(source.lines for source in summary.values() if source.status == "ok")
+        metrics.counters.update({
+            "sources": len(log_folders),
+            "lines": line_count,
+            "parsed_lines": line_count,  # источники всегда разбираются целиком
+            "error_count": sum(source.errors for source in summary.values() if source.status == "ok"),
+            "url_count": len(log_info),
+        })
+        metrics.save(metrics_file_path(html_save))
+    return summary
+
+
+def _limit_worker_memory(memory_limit_mb: int) -> None:
+    """Ограничивает данные процесса (кучу и анонимные отображения) через RLIMIT_DATA. RLIMIT_AS не подходит:
+    он учитывает и mmap лога в MmapLogReader, и несжатый лог больше лимита не разобрать даже с одним url"""
+    if memory_limit_mb > 0 and resource is not None:
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+
+def _backfill_log(
+        log_path: str,
+        html_save: str,
+        max_error_ratio: float,
+        report_size: int,
+        *,
+        cache_path: tp.Optional[str] = None,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        write_metrics: bool = False,
+        time_bucket: tp.Optional[str] = None,
+        time_series_top: int = 20,
+        percentiles: bool = False,
+        backend: str = "python",
+        history_db: tp.Optional[str] = None,
+) -> tp.Tuple[bool, str]:
+    try:
+        return build_report(
+            log_path,
+            html_save,
+            max_error_ratio,
+            report_size=report_size,
+            cache_path=cache_path,
+            url_normalizer=url_normalizer,
+            metrics=Metrics() if write_metrics else None,
+            time_bucket=time_bucket,
+            time_series_top=time_series_top,
+            percentiles=percentiles,
+            backend=backend,
+            history_db=history_db,
+        )
+    except MemoryError:
+        return False, "memory limit exceeded"
+    except Exception as exc:
+        logging.exception(exc.args)
+        return False, f"failed: {exc!r}"
+
+
+def backfill_folder(
+        log_folder: str,
+        report_folder: str,
+        max_error_ratio: float,
+        report_size: int = 0,
+        *,
+        workers: int = 1,
+        memory_limit_mb: int = 0,
+        cache_folder: tp.Optional[str] = None,
+        url_normalizer: tp.Optional[UrlNormalizer] = None,
+        write_metrics: bool = False,
+        index_path: tp.Optional[str] = None,
+        time_bucket: tp.Optional[str] = None,
+        time_series_top: int = 20,
+        percentiles: bool = False,
+        backend: str = "python",
+        history_db: tp.Optional[str] = None,
+) -> tp.Dict[str, tp.Tuple[bool, str]]:
+    """Строит репорты для всех логов папки, у которых еще нет репорта, по логу на процесс.
+    Одновременно разбирается не больше workers логов, каждому процессу можно ограничить
+    память под данные memory_limit_mb мегабайтами (отображение файла лога в нее не входит)"""
+    jobs = {}
+    for log_name, date_str in provide_all_logs_and_dates(log_folder, index_path):
+        html_save = os.path.join(report_folder, f"report-{date_str}.html")
+        if not os.path.exists(html_save):
+            jobs[log_name] = (os.path.join(log_folder, log_name), html_save)
+    if len(jobs) == 0:
+        logging.info("No unreported log files to work, exit")
+        return {}
+    summary = {}
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(1, min(workers, len(jobs))),
+            initializer=_limit_worker_memory,
+            initargs=(memory_limit_mb,),
+    ) as executor:
+        futures = {
+            executor.submit(
+                _backfill_log,
+                log_path,
+                html_save,
+                max_error_ratio,
+                report_size,
+                cache_path=aggregate_cache_path(cache_folder, log_name, url_normalizer, percentiles),
+                url_normalizer=url_normalizer,
+                write_metrics=write_metrics,
+                time_bucket=time_bucket,
+                time_series_top=time_series_top,
+                percentiles=percentiles,
+                backend=backend,
+                history_db=history_db,
+            ): log_name
+            for log_name, (log_path, html_save) in jobs.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            log_name = futures[future]
+            try:
+                summary[log_name] = future.result()
+            except Exception as exc:  # например, процесс убит при нехватке памяти
+                summary[log_name] = False, f"failed: {exc!r}"
+    for log_name in sorted(summary):
+        is_created, message = summary[log_name]
+        if is_created:
+            logging.info(f"{log_name}: OK, {message}")
+        else:
+            logging.error(f"{log_name}: ERROR, {message}")
+    logging.info(f"backfill finished: {sum(ok for ok, _ in summary.values())} of {len(summary)} logs reported")
+    return summary
+
+
+class LogWatcher:
+    """Режим --watch: процесс остается в памяти, проверяет LOG_DIR и активный лог через stat,
+    дочитывает прирост лога в агрегаты и перестраивает репорт по расписанию или по SIGHUP.
+    Когда появляется лог следующего дня, репорт предыдущего дописывается окончательно, а его
+    агрегаты освобождаются, поэтому память ограничена объемом одного дня лога.
+    Состояние активного лога хранится в формате контрольной точки и при checkpoint_folder
+    сохраняется вместе с репортом, так что после перезапуска разбор продолжается с того же места"""
+
+    def __init__(
+            self,
+            log_folder: str,
+            report_folder: str,
+            max_error_ratio: float,
+            report_size: int = 0,
+            *,
+            checkpoint_folder: tp.Optional[str] = None,
+            url_normalizer: tp.Optional[UrlNormalizer] = None,
+            index_path: tp.Optional[str] = None,
+            percentiles: bool = False,
+            history_db: tp.Optional[str] = None,
+    ):
+        self.log_folder = log_folder
+        self.report_folder = report_folder
+        self.max_error_ratio = max_error_ratio
+        self.report_size = report_size
+        self.checkpoint_folder = checkpoint_folder
+        self.url_normalizer = url_normalizer
+        self.index_path = index_path
+        self.percentiles = percentiles
+        self.history_db = history_db
+        self.log_name = None
+        self.date_str = None
+        self._folder_mtime = None
+        self._state = None
+        self._dirty = False
+        self._stopping = False
+        self._report_requested = False
+        self._wake = threading.Event()
+
+    def _log_path(self) -> str:
+        return os.path.join(self.log_folder, self.log_name)
+
+    def _checkpoint_path(self) -> tp.Optional[str]:
+        if self.log_name.lower().endswith(".gz"):
+            return None
+        return _state_file_path(
+            self.checkpoint_folder, self.log_name, "checkpoint", self.url_normalizer, self.percentiles
+        )
+
+    def _empty_state(self) -> tp.Dict[str, tp.Any]:
+        return {"version": CHECKPOINT_VERSION, "offset": 0, "error_count": 0, "stat_info": {}}
+
+    def _open_log(self, log_name: str, date_str: str) -> None:
+        if self.log_name is not None:
+            self.poll_log()  # строки, дописанные в старый лог до ротации
+            if self.write_report(force=True) and self.history_db is not None:
+                _save_log_history(
+                    self.history_db, self._log_path(), self._state["stat_info"], self._state["error_count"]
+                )
+            logging.info(f"log {self.log_name} was rotated, report for {self.date_str} is final")
+        self.log_name, self.date_str = log_name, date_str
+        self._state = self._empty_state()
+        self._dirty = True
+        checkpoint_path = self._checkpoint_path()
+        checkpoint = load_checkpoint(checkpoint_path, with_stat_info=False) if checkpoint_path is not None else None
+        if checkpoint is not None and checkpoint_resume_offset(self._log_path(), checkpoint) > 0:
+            checkpoint = load_checkpoint(checkpoint_path)
+            if checkpoint is not None:
+                logging.info(f"resume {log_name} from offset {checkpoint['offset']}")
+                self._state = checkpoint
+        logging.info(f"watching {log_name}")
+
+    def poll_folder(self) -> None:
+        """Переключается на самый новый лог папки. Папка пересматривается, только если изменилось
+        ее время модификации или оно слишком свежее, чтобы ему доверять"""
+        folder_mtime = os.stat(self.log_folder).st_mtime_ns
+        if (
+            self.log_name is not None
+            and folder_mtime == self._folder_mtime
+            and time.time_ns() - folder_mtime >= LOG_INDEX_RACY_NS
+        ):
+            return
+        self._folder_mtime = folder_mtime
+        log_name, date_str = provide_last_log_path_and_date(self.log_folder, self.index_path)
+        if log_name is not None and log_name != self.log_name:
+            self._open_log(log_name, date_str)
+
+    def poll_log(self) -> bool:
+        """Дочитывает в агрегаты прирост активного лога, True - агрегаты изменились"""
+        if self.log_name is None:
+            return False
+        log_path = self._log_path()
+        try:
+            stat = os.stat(log_path)
+        except FileNotFoundError:
+            return False
+        state = self._state
+        if state["offset"] > 0 and (stat.st_ino, stat.st_size, stat.st_mtime_ns) == (
+                state["inode"], state["size"], state["mtime"]):
+            return False
+        if log_path.lower().endswith(".gz"):  # сжатый лог не дописывается, он читается целиком
+            state = self._state = self._empty_state()
+            stat_info, error_count = process_log_info(
+                _read_log(log_path), url_normalizer=self.url_normalizer, percentiles=self.percentiles
+            )
+            end = stat.st_size
+        else:
+            if state["offset"] > 0 and checkpoint_resume_offset(log_path, state) == 0:
+                state = self._state = self._empty_state()
+            end = _last_line_end(log_path, state["offset"], stat.st_size)
+            if end <= state["offset"]:
+                return False
+            stat_info, error_count = _process_log_range(
+                log_path, state["offset"], end, self.url_normalizer, percentiles=self.percentiles
+            )
+        head_size = state["head_size"] if state["offset"] > 0 else min(CHECKPOINT_HEAD_SIZE, end)
+        merge_stat_info(state["stat_info"], stat_info)
+        state["error_count"] += error_count
+        state["offset"] = end
+        state.update(_file_identity(log_path, head_size, stat))
+        self._dirty = True
+        return True
+
+    def report_rows(self) -> tp.List[dict]:
+        return calculate_stat_info(self._state["stat_info"], self.report_size)
+
+    def write_report(self, force: bool = False) -> bool:
+        """Перестраивает репорт активного лога, если агрегаты изменились с прошлой записи"""
+        if self.log_name is None or not (self._dirty or force):
+            return False
+        self._dirty = False
+        error_count = self._state["error_count"]
+        line_count = sum(info.count() for info in self._state["stat_info"].values()) + error_count
+        if line_count == 0:
+            return False
+        error_ratio = float(error_count) / line_count
+        if error_ratio > self.max_error_ratio:
+            logging.error(f"{self.log_name} has too many error(error_ratio is {error_ratio}), report was not updated")
+            return False
+        html_save = os.path.join(self.report_folder, f"report-{self.date_str}.html")
+        create_html_file(html_save, self.report_rows())
+        checkpoint_path = self._checkpoint_path()
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, self._state)
+        logging.info(f"report {html_save} was updated, {line_count} lines")
+        return True
+
+    def request_report(self, *_: tp.Any) -> None:
+        self._report_requested = True
+        self._wake.set()
+
+    def stop(self, *_: tp.Any) -> None:
+        self._stopping = True
+        self._wake.set()
+
+    def install_signal_handlers(self) -> None:
+        """SIGHUP - перестроить репорт сейчас, SIGTERM и SIGINT - дописать репорт и выйти"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if hasattr(signal, "SIGHUP"):  # нет на Windows
+            signal.signal(signal.SIGHUP, self.request_report)
+
+    def run(self, poll_interval: float, report_interval: float) -> None:
+        next_report = time.monotonic() + report_interval
+        while not self._stopping:
+            try:
+                self.poll_folder()
+                self.poll_log()
+                if self._report_requested or time.monotonic() >= next_report:
+                    self._report_requested = False
+                    next_report = time.monotonic() + report_interval
+                    self.write_report()
+            except Exception as exc:
+                logging.exception(exc.args)
+            self._wake.wait(poll_interval)
+            self._wake.clear()
+        self.write_report()
+        logging.info("watch stopped")
 
 
 def prepare_logging(filename: tp.Optional[str]) -> None:
@@ -227,10 +2505,139 @@ def read_config(filename: str) -> tp.Dict[str, tp.Any]:
 
 
 def main(argv: tp.List[str]) -> None:
-    config = read_config(argv[0]) if len(argv) > 0 else default_config
+    parser = argparse.ArgumentParser(description="nginx ui_short log analyzer")
+    parser.add_argument("config", nargs="?", help="JSON config file")
+    parser.add_argument("--backfill", action="store_true", help="build reports for every unreported log in LOG_DIR")
+    parser.add_argument("--watch", action="store_true", help="stay resident, tail the newest log, refresh its report")
+    parser.add_argument(
+        "--history",
+        nargs=2,
+        metavar=("FROM", "TO"),
+        type=datetime.date.fromisoformat,
+        help="build a report for the YYYY-MM-DD period from HISTORY_DB without parsing logs",
+    )
+    parser.add_argument("--url", help="with --history, print daily aggregates of this url as CSV instead")
+    parser.add_argument(
+        "--compare",
+        nargs="+",
+        metavar="DATE",
+        type=datetime.date.fromisoformat,
+        help="report urls that got slower on the last YYYY-MM-DD date than on the others or the day before",
+    )
+    args = parser.parse_args(argv)
+    config = read_config(args.config) if args.config else default_config
     prepare_logging(config.get("LOG_FILE", None))
+    url_rules = config["URL_NORMALIZATION"]
+    url_normalizer = UrlNormalizer(url_rules) if url_rules else None
     try:
-        process_folder(config["LOG_DIR"], config["REPORT_DIR"], config["ERROR_MAX_RATIO"], config["REPORT_SIZE"])
+        if config["TIME_BUCKET"] is not None and config["TIME_BUCKET"] not in TIME_BUCKETS:
+            raise ValueError(f"TIME_BUCKET must be one of {', '.join(TIME_BUCKETS)}, got {config['TIME_BUCKET']!r}")
+        backend = resolve_aggregation_backend(config["AGGREGATION_BACKEND"])
+        is_multi_source = isinstance(config["LOG_DIR"], list)
+        if is_multi_source and (args.backfill or args.watch):
+            raise ValueError("--backfill and --watch work with a single LOG_DIR, not a list")
+        if (args.history or args.compare) and config["HISTORY_DB"] is None:
+            raise ValueError("--history and --compare need HISTORY_DB in config")
+        if args.history and args.url:
+            rows = history_trend(config["HISTORY_DB"], args.url, *args.history)
+            writer = csv.DictWriter(sys.stdout, ("date", "url", "count", "time_sum", "time_max", "time_med")
+                                    + tuple(f"time_p{percent}" for percent in REPORT_PERCENTILES))
+            writer.writeheader()
+            writer.writerows(rows)
+        elif args.history:
+            html_save = build_history_report(config["HISTORY_DB"], config["REPORT_DIR"], *args.history,
+                                             report_size=config["REPORT_SIZE"])
+            if html_save is None:
+                logging.error("no aggregates for this period in history, exit")
+            else:
+                logging.info(f"report {html_save} was created from history")
+        elif args.compare:
+            dates = args.compare
+            if len(dates) == 1:
+                dates = [dates[0] - datetime.timedelta(days=1), dates[0]]
+            if not is_multi_source:
+                unknown = fill_history(
+                    config["HISTORY_DB"],
+                    config["LOG_DIR"],
+                    dates,
+                    config["ERROR_MAX_RATIO"],
+                    cache_folder=config["CACHE_DIR"],
+                    url_normalizer=url_normalizer,
+                    index_path=config["LOG_INDEX_FILE"],
+                    percentiles=config["PERCENTILES"],
+                )
+            else:
+                unknown = [date for date in dates if date not in history_dates(config["HISTORY_DB"])]
+            if unknown:
+                raise ValueError(f"no aggregates and no logs for {', '.join(map(str, unknown))}")
+            html_save = build_regression_report(config["HISTORY_DB"], config["REPORT_DIR"], dates,
+                                                thresholds=config["REGRESSION_THRESHOLDS"],
+                                                report_size=config["REPORT_SIZE"])
+            logging.info(f"regression report {html_save} was created")
+        elif args.backfill:
+            backfill_folder(
+                config["LOG_DIR"],
+                config["REPORT_DIR"],
+                config["ERROR_MAX_RATIO"],
+                report_size=config["REPORT_SIZE"],
+                workers=config["BACKFILL_WORKERS"],
+                memory_limit_mb=config["BACKFILL_MEMORY_LIMIT_MB"],
+                cache_folder=config["CACHE_DIR"],
+                url_normalizer=url_normalizer,
+                write_metrics=config["WRITE_METRICS"],
+                index_path=config["LOG_INDEX_FILE"],
+                time_bucket=config["TIME_BUCKET"],
+                time_series_top=config["TIME_SERIES_TOP_URLS"],
+                percentiles=config["PERCENTILES"],
+                backend=backend,
+                history_db=config["HISTORY_DB"],
+            )
+        elif args.watch:
+            watcher = LogWatcher(
+                config["LOG_DIR"],
+                config["REPORT_DIR"],
+                config["ERROR_MAX_RATIO"],
+                report_size=config["REPORT_SIZE"],
+                checkpoint_folder=config["CHECKPOINT_DIR"],
+                url_normalizer=url_normalizer,
+                index_path=config["LOG_INDEX_FILE"],
+                percentiles=config["PERCENTILES"],
+                history_db=config["HISTORY_DB"],
+            )
+            watcher.install_signal_handlers()
+            watcher.run(config["WATCH_POLL_INTERVAL"], config["WATCH_REPORT_INTERVAL"])
+        elif is_multi_source:
+            for key in multi_source_ignored_keys(config):
+                logging.warning(f"{key} is ignored when LOG_DIR is a list")
+            process_sources(
+                config["LOG_DIR"],
+                config["REPORT_DIR"],
+                config["ERROR_MAX_RATIO"],
+                report_size=config["REPORT_SIZE"],
+                workers=config["WORKERS"],
+                url_normalizer=url_normalizer,
+                write_metrics=config["WRITE_METRICS"],
+                percentiles=config["PERCENTILES"],
+                history_db=config["HISTORY_DB"],
+            )
+        else:
+            process_folder(
+                config["LOG_DIR"],
+                config["REPORT_DIR"],
+                config["ERROR_MAX_RATIO"],
+                report_size=config["REPORT_SIZE"],
+                workers=config["WORKERS"],
+                checkpoint_folder=config["CHECKPOINT_DIR"],
+                cache_folder=config["CACHE_DIR"],
+                url_normalizer=url_normalizer,
+                write_metrics=config["WRITE_METRICS"],
+                index_path=config["LOG_INDEX_FILE"],
+                time_bucket=config["TIME_BUCKET"],
+                time_series_top=config["TIME_SERIES_TOP_URLS"],
+                percentiles=config["PERCENTILES"],
+                backend=backend,
+                history_db=config["HISTORY_DB"],
+            )
     except Exception as ex:
         logging.exception(ex.args)
 
@@ -27,10 +27,18 @@
 # Можно свободно определять свои функции и т.п.
 # -----------------
 
+import array
+import functools
 import itertools
+import random
 import typing as tp
 from typing import Union, Optional
 
+try:
+    import numpy as np
+except ImportError:  # best_hand_scores считает без numpy, по руке за итерацию
+    np = None
+
 
 def card_rank(card: str) -> int:
     if card[0] == "J":
@@ -51,18 +59,23 @@ def remove_sublist_from_list(source: tp.List[int], what_remove: tp.List[int]) ->
     return list(filter(lambda x: x not in what_remove, source))
 
 
-def hand_rank(hand: tp.List[str]) -> Union[
+def hand_rank(hand: tp.List[str]) -> int:
+    """Возвращает значение определяющее ранг 'руки' из 5 карт: целое число, чем больше, тем сильнее рука"""
+    return hand_score(hand_codes(hand))
+
+
+def rank_pattern(ranks: tp.List[int], is_flush: bool) -> Union[
     tuple[int, int], tuple[int, Optional[int], Optional[int]], tuple[int, int, list[int]], tuple[
         int, Optional[int], list[int]], tuple[int, Optional[list[int]], int], tuple[int, list[int]]]:
-    """Возвращает значение определяющее ранг 'руки'"""
-    ranks = card_ranks(hand)
-    if straight(ranks) and flush(hand):  # стритфлеш
+    """Категория руки и ранги для сравнения внутри категории по отсортированным от большего
+    к меньшему рангам 5 карт"""
+    if straight(ranks) and is_flush:  # стритфлеш
         return 8, max(ranks)  # пока двоякая форма туза (как туз и как единичка) не реализована
     elif kind(4, ranks):  # каре
         return 7, kind(4, ranks), kind(1, ranks)
     elif kind(3, ranks) and kind(2, ranks):  # фуллхаус
         return 6, kind(3, ranks), kind(2, ranks)
-    elif flush(hand):  # флеш
+    elif is_flush:  # флеш
         return 5, max(ranks), ranks
     elif straight(ranks):  # стрит
         return 4, max(ranks)
@@ -76,6 +89,29 @@ def hand_rank(hand: tp.List[str]) -> Union[
         return 0, ranks
 
 
+def pattern_score(pattern: tp.Tuple[tp.Any, ...]) -> int:
+    """Упаковывает категорию и ранги rank_pattern в целое число по 4 бита на ранг, так что числа
+    сравниваются так же, как кортежи: без потерь точности на кикерах"""
+    category, *sub_ranks = pattern
+    score = 0
+    width = 0
+    for sub_rank in sub_ranks:
+        for rank in sub_rank if isinstance(sub_rank, list) else [sub_rank]:
+            score = score << 4 | rank
+            width += 1
+    return category << 4 * PATTERN_WIDTH | score << 4 * (PATTERN_WIDTH - width)
+
+
+def score_ranks(score: int) -> tp.Set[int]:
+    """Ранги карт (2..14), из которых состоит рука со значением score"""
+    category = score >> 4 * PATTERN_WIDTH
+    ranks = {score >> 4 * idx & 15 for idx in range(PATTERN_WIDTH)} - {0}
+    if category in (4, 8):  # у стритов в значении только старшая карта
+        high = max(ranks)
+        return set(range(high - 4, high + 1))
+    return ranks
+
+
 def card_ranks(hand: tp.List[str]) -> tp.List[int]:
     """Возвращает список рангов (его числовой эквивалент),
     отсортированный от большего к меньшему"""
@@ -146,42 +182,162 @@ def two_pair(ranks: tp.List[int]) -> tp.Optional[tp.List[int]]:
     return None
 
 
-def sub_rank_power(sub_rank: tp.Any) -> float:
-    if sub_rank is None:
-        return 0.0
-    if type(sub_rank) is int:
-        return sub_rank
-    elif type(sub_rank) is str:
-        return card_rank(sub_rank)
-    elif type(sub_rank) is list:
-        sub_power = 0
-        for idx, val in enumerate(sub_rank):
-            sub_power += val * 0.01 ** idx
-        return sub_power
-    else:
-        raise RuntimeError(f"Неизвестный тип для сравнения {type(sub_rank)}")
-
-
-def hand_power(rank: tp.Tuple[tp.Any, tp.Any, tp.Any]) -> float:
-    result = rank[0] if type(rank[0]) is int else card_rank(rank[0])
-    if len(rank) > 1 and rank[1] is not None:
-        result += 0.01 * sub_rank_power(rank[1])
-    if len(rank) > 2 and rank[2] is not None:
-        result += 0.000001 * sub_rank_power(rank[2])
-    return result
+PATTERN_WIDTH = 6  # больше всего рангов у флеша: старшая карта и все 5 карт
+RANK_PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)  # для рангов 2..14, произведение не зависит от порядка
+
+
+def _build_tables() -> tp.Tuple[tp.List[int], tp.List[int], tp.Dict[int, int]]:
+    flush_scores = [0] * (1 << 13)
+    unique_scores = [0] * (1 << 13)
+    paired_scores = {}
+    for ranks in itertools.combinations_with_replacement(range(14, 1, -1), 5):
+        ranks = list(ranks)
+        if len(set(ranks)) == 5:
+            mask = sum(1 << (rank - 2) for rank in ranks)
+            flush_scores[mask] = pattern_score(rank_pattern(ranks, True))
+            unique_scores[mask] = pattern_score(rank_pattern(ranks, False))
+        elif ranks.count(ranks[2]) < 5:  # пять одинаковых рангов в колоде без джокеров не бывает
+            product = 1
+            for rank in ranks:
+                product *= RANK_PRIMES[rank - 2]
+            paired_scores[product] = pattern_score(rank_pattern(ranks, False))
+    return flush_scores, unique_scores, paired_scores
+
+
+_FLUSH_SCORES, _UNIQUE_SCORES, _PAIRED_SCORES = _build_tables()
+
+# Карта кодируется числом 0..51: 4 * (ранг - 2) + масть, рука - списком кодов; при оценке из них собираются
+# 13-битные маски рангов по мастям и произведение простых чисел рангов.
+# Черные масти - 0 и 1, красные - 2 и 3. Строки нужны только на входе и выходе
+RANKS = "23456789TJQKA"
+SUITS = "CSHD"
+_CARD_CODES = {rank + suit: 4 * rank_idx + suit_idx
+               for rank_idx, rank in enumerate(RANKS) for suit_idx, suit in enumerate(SUITS)}
+_CARD_NAMES = sorted(_CARD_CODES, key=_CARD_CODES.get)
+_CARD_BITS = [1 << (code >> 2) for code in range(52)]
+_CARD_PRIMES = [RANK_PRIMES[code >> 2] for code in range(52)]
+BATCH_HAND_SIZE = 7
+
+
+def card_code(card: str) -> int:
+    return _CARD_CODES[card]
+
+
+def card_name(code: int) -> str:
+    return _CARD_NAMES[code]
+
+
+def hand_codes(hand: tp.Iterable[str]) -> tp.List[int]:
+    return [_CARD_CODES[card] for card in hand]
+
+
+def hand_score(codes: tp.Iterable[int]) -> int:
+    """hand_rank руки из 5 карт, заданных кодами. Берется из таблиц, построенных при импорте:
+    для 5 разных рангов - по маске рангов (отдельно для флешей), для рук с повторяющимися рангами -
+    по произведению простых чисел, сопоставленных рангам"""
+    mask = 0
+    product = 1
+    suits = 0
+    for code in codes:
+        mask |= _CARD_BITS[code]
+        product *= _CARD_PRIMES[code]
+        suits |= 1 << (code & 3)
+    if product in _PAIRED_SCORES:
+        return _PAIRED_SCORES[product]
+    return _FLUSH_SCORES[mask] if suits & (suits - 1) == 0 else _UNIQUE_SCORES[mask]
+
+
+@functools.lru_cache(maxsize=None)
+def _best_score_tables() -> tp.Tuple[tp.List[int], tp.Dict[int, int]]:
+    """Таблицы лучшей руки из 5 карт среди 5-7 карт: по маске рангов одной масти (0, если карт в ней меньше 5)
+    и по произведению простых чисел рангов без учета флеша. Строятся при первом обращении из 5-карточных:
+    лучшая рука из n карт - лучшая из рук n - 1 карт без одной из них"""
+    flush_scores = list(_FLUSH_SCORES)
+    rank_scores = dict(_PAIRED_SCORES)
+    for mask, score in enumerate(_UNIQUE_SCORES):
+        if score:
+            product = 1
+            for rank_idx in range(13):
+                if mask >> rank_idx & 1:
+                    product *= RANK_PRIMES[rank_idx]
+            rank_scores[product] = score
+    for size in (6, BATCH_HAND_SIZE):
+        for rank_idxs in itertools.combinations_with_replacement(range(13), size):
+            distinct = set(rank_idxs)
+            if any(rank_idxs.count(rank_idx) > 4 for rank_idx in distinct):
+                continue
+            product = 1
+            for rank_idx in rank_idxs:
+                product *= RANK_PRIMES[rank_idx]
+            rank_scores[product] = max(rank_scores[product // RANK_PRIMES[rank_idx]] for rank_idx in distinct)
+        for rank_idxs in itertools.combinations(range(13), size):
+            mask = sum(1 << rank_idx for rank_idx in rank_idxs)
+            flush_scores[mask] = max(flush_scores[mask & ~(1 << rank_idx)] for rank_idx in rank_idxs)
+    return flush_scores, rank_scores
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy_tables() -> tp.Tuple["np.ndarray", "np.ndarray", "np.ndarray", "np.ndarray", "np.ndarray"]:
+    flush_scores, rank_scores = _best_score_tables()
+    rank_keys = np.array(sorted(rank_scores), dtype=np.int64)
+    rank_values = np.array([rank_scores[key] for key in rank_keys.tolist()], dtype=np.int64)
+    return (np.array(_CARD_PRIMES, dtype=np.int64), np.array(_CARD_BITS, dtype=np.int64), rank_keys, rank_values,
+            np.array(flush_scores, dtype=np.int64))
+
+
+def best_score(codes: tp.Iterable[int]) -> int:
+    """hand_rank лучшей руки из 5 карт среди 5-7 карт, заданных кодами, без перебора сочетаний"""
+    flush_scores, rank_scores = _best_score_tables()
+    product = 1
+    suit_masks = [0, 0, 0, 0]
+    for code in codes:
+        product *= _CARD_PRIMES[code]
+        suit_masks[code & 3] |= _CARD_BITS[code]
+    return max(rank_scores[product], *(flush_scores[mask] for mask in suit_masks))
+
+
+def best_hand_scores(hands: tp.Any) -> tp.Union[array.array, "np.ndarray"]:
+    """best_score для многих рук из 7 карт за один вызов. hands - список рук (карты строками или кодами)
+    или буфер кодов карт по 7 подряд на руку: bytes, array.array, numpy.ndarray формы (n, 7).
+    С numpy руки считаются векторно и возвращается numpy.ndarray int64, без него - array("q").
+    Рука не из 7 карт или буфер с длиной не кратной 7 - ValueError, а не молча потерянные или сдвинутые карты"""
+    if isinstance(hands, list):
+        if any(len(hand) != BATCH_HAND_SIZE for hand in hands):
+            raise ValueError(f"every hand must have {BATCH_HAND_SIZE} cards")
+        hands = array.array("B", [card if isinstance(card, int) else _CARD_CODES[card]
+                                  for hand in hands for card in hand])
+    elif isinstance(hands, (bytes, bytearray)):
+        hands = memoryview(hands)
+    if np is not None and isinstance(hands, np.ndarray):
+        if hands.ndim != 2 or hands.shape[1] != BATCH_HAND_SIZE:
+            raise ValueError(f"hands array must have shape (n, {BATCH_HAND_SIZE}), got {hands.shape}")
+    elif len(hands) % BATCH_HAND_SIZE != 0:
+        raise ValueError(f"buffer length {len(hands)} is not a multiple of {BATCH_HAND_SIZE}")
+    if np is None:
+        return array.array("q", (
+            best_score(hands[start:start + BATCH_HAND_SIZE]) for start in range(0, len(hands), BATCH_HAND_SIZE)
+        ))
+    card_primes, card_bits, rank_keys, rank_values, flush_scores = _numpy_tables()
+    codes = np.asarray(hands).astype(np.intp).reshape(-1, BATCH_HAND_SIZE)
+    scores = rank_values[np.searchsorted(rank_keys, card_primes[codes].prod(axis=1))]
+    suits = codes & 3
+    bits = card_bits[codes]
+    for suit in range(len(SUITS)):
+        np.maximum(scores, flush_scores[np.where(suits == suit, bits, 0).sum(axis=1)], out=scores)
+    return scores
 
 
 def best_hand(hand: tp.List[str]) -> tp.List[str]:
-    """Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт """
-    best = None
-    power = 0
-    for test_hand in itertools.combinations(hand, 5):
-        rank = hand_rank(test_hand)
-        test_power = hand_power(rank)
-        if test_power > power:
-            best = test_hand
-            power = test_power
-    return sorted(best)
+    """Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт. Из равных по силе рук берется
+    наибольший отсортированный список карт, так что результат не зависит от порядка карт"""
+    combinations = list(itertools.combinations(hand_codes(hand), 5))
+    scores = [hand_score(combination) for combination in combinations]
+    top_score = max(scores)
+    return max(
+        sorted(card_name(code) for code in combination)
+        for combination, score in zip(combinations, scores)
+        if score == top_score
+    )
 
 
 def generate_all_card_suite(suite: str) -> tp.List[str]:
@@ -214,29 +370,153 @@ def prepare_hand_iterator(hand: tp.List[str]) -> tp.Generator[tp.List[str], None
     if joker_iterators:
         for joker_cards in joker_iterators:
             result_card = clear_cards.copy()
-            if type(joker_cards) == str:
-                result_card.append(joker_cards)
-            else:
-                result_card += [card for card in joker_cards if card not in result_card]
-            if len(result_card) < 7:
+            if isinstance(joker_cards, str):
+                joker_cards = [joker_cards]
+            result_card += [card for card in joker_cards if card not in result_card]
+            if len(result_card) < len(hand):  # джокер не может стать картой, которая уже есть в руке
                 continue
             yield result_card
     else:
         yield hand
 
 
-def best_wild_hand(hand: tp.List[str]):
-    """best_hand но с джокерами"""
+def best_wild_hand_brute_force(hand: tp.List[str]) -> tp.List[str]:
+    """best_wild_hand полным перебором замен джокеров, эталон для проверки best_wild_hand"""
     best = None
-    power = 0
     for wild_hand in prepare_hand_iterator(hand):
-        rank = best_hand(wild_hand)
-        test_power = hand_power(hand_rank(rank))
-        if test_power > power:
-            best = rank
-            power = test_power
-    print(f"result wild hand = {sorted(best)}")
-    return sorted(best)
+        cards = best_hand(wild_hand)
+        key = hand_rank(cards), cards  # равные по силе руки - как в best_hand
+        if best is None or key > best:
+            best = key
+    return best[1]
+
+
+JOKER_SUITS = {"?B": (0, 1), "?R": (2, 3)}  # коды мастей, которые может принять джокер
+
+
+def _assign_jokers(
+        jokers: tp.List[tp.Tuple[int, ...]], cards: tp.List[int]
+) -> tp.Optional[tp.List[tp.Optional[int]]]:
+    """Раскладывает карты по джокерам подходящего цвета: карта для каждого джокера, None - джокер свободен.
+    None, если так разложить нельзя"""
+    if len(cards) > len(jokers):
+        return None
+    for order in itertools.permutations(range(len(jokers)), len(cards)):
+        if all(card & 3 in jokers[joker_idx] for card, joker_idx in zip(cards, order)):
+            assignment = [None] * len(jokers)
+            for card, joker_idx in zip(cards, order):
+                assignment[joker_idx] = card
+            return assignment
+    return None
+
+
+def _kind_cards(real_mask: int, needs: tp.List[tp.Tuple[int, int]], joker_count: int) -> tp.List[tp.List[int]]:
+    """Варианты недостающих карт, чтобы в руке было не меньше count карт ранга rank_idx для каждой пары needs"""
+    options = []
+    deficit = 0
+    for rank_idx, count in needs:
+        absent = [4 * rank_idx + suit for suit in range(4) if not real_mask >> (4 * rank_idx + suit) & 1]
+        missing = max(0, count - (4 - len(absent)))
+        deficit += missing
+        if deficit > joker_count:
+            return []
+        options.append(itertools.combinations(absent, missing))
+    return [[card for part in parts for card in part] for parts in itertools.product(*options)]
+
+
+def _wild_groups(
+        real_mask: int, jokers: tp.List[tp.Tuple[int, ...]]
+) -> tp.Generator[tp.List[tp.List[int]], None, None]:
+    """Наборы карт, которые должны дать джокеры, сгруппированные по убыванию силы руки: от стритфлешей
+    по старшей карте к каре, фуллхаусам и т.д. Все руки группы одной категории с одинаковыми определяющими
+    рангами, руки следующих групп заведомо слабее, если в группе есть выполнимый набор"""
+    ranks = range(12, -1, -1)
+    highs = range(12, 3, -1)  # туз как единичка пока не поддерживается
+    for high in highs:  # стритфлеш
+        yield [[4 * rank_idx + suit for rank_idx in range(high - 4, high + 1)
+                if not real_mask >> (4 * rank_idx + suit) & 1] for suit in range(4)]
+    for rank_idx in ranks:  # каре
+        yield _kind_cards(real_mask, [(rank_idx, 4)], len(jokers))
+    for three in ranks:  # фуллхаус
+        for pair in ranks:
+            if pair != three:
+                yield _kind_cards(real_mask, [(three, 3), (pair, 2)], len(jokers))
+    flushes = []  # флеш: джокеры масти берут ее старшие карты, которых нет в руке
+    for suit in range(4):
+        suit_jokers = sum(1 for joker in jokers if suit in joker)
+        free = [4 * rank_idx + suit for rank_idx in ranks if not real_mask >> (4 * rank_idx + suit) & 1]
+        if 13 - len(free) + suit_jokers >= 5:
+            flushes.append(free[:suit_jokers])
+    yield flushes
+    for high in highs:  # стрит
+        yield _kind_cards(real_mask, [(rank_idx, 1) for rank_idx in range(high - 4, high + 1)], len(jokers))
+    for rank_idx in ranks:  # сет
+        yield _kind_cards(real_mask, [(rank_idx, 3)], len(jokers))
+    for high_pair in ranks:  # две пары
+        for low_pair in range(high_pair - 1, -1, -1):
+            yield _kind_cards(real_mask, [(high_pair, 2), (low_pair, 2)], len(jokers))
+    for rank_idx in ranks:  # пара
+        yield _kind_cards(real_mask, [(rank_idx, 2)], len(jokers))
+    yield [[]]  # набор карт
+
+
+def resolve_jokers(codes: tp.List[int], jokers: tp.List[tp.Tuple[int, ...]]) -> tp.List[int]:
+    """Карты, которыми лучше всего заменить джокеры (jokers - масти каждого джокера) при картах руки codes.
+    Категории перебираются сверху вниз, для каждой проверяются только замены, которые могут ее дать,
+    и перебор останавливается на первой выполнимой группе _wild_groups. Свободные после этого джокеры
+    становятся старшей картой своего цвета, которой нет в руке: выше категории уже не получить,
+    так что они могут быть только кикерами"""
+    real_mask = 0
+    for code in codes:
+        real_mask |= 1 << code
+    for group in _wild_groups(real_mask, jokers):
+        best = None
+        for cards in group:
+            assignment = _assign_jokers(jokers, cards)
+            if assignment is None:
+                continue
+            taken = real_mask | sum(1 << card for card in cards)
+            for joker_idx, joker in enumerate(jokers):
+                if assignment[joker_idx] is None:
+                    assignment[joker_idx] = max(
+                        code for code in range(52) if code & 3 in joker and not taken >> code & 1
+                    )
+                    taken |= 1 << assignment[joker_idx]
+            score = best_score(codes + assignment)
+            if best is None or score > best[0]:
+                best = score, assignment
+        if best is not None:
+            return best[1]
+    raise RuntimeError("no joker substitution found")
+
+
+def best_wild_hand(hand: tp.List[str]) -> tp.List[str]:
+    """best_hand но с джокерами"""
+    cards = [card for card in hand if card not in JOKER_SUITS]
+    jokers = [JOKER_SUITS[card] for card in hand if card in JOKER_SUITS]
+    if len(jokers) == 0:
+        return best_hand(hand)
+    codes = hand_codes(cards)
+    score = best_score(codes + resolve_jokers(codes, jokers))
+    # сила руки известна, осталось выбрать из равных по силе рук ту же, что и best_hand: джокерам имеет смысл
+    # становиться только картами рангов этой руки, остальные варианты в лучшие 5 карт не попадут
+    ranks = score_ranks(score)
+    options = [
+        [None] + [code for code in range(52)
+                  if code & 3 in joker and (code >> 2) + 2 in ranks and code not in codes]
+        for joker in jokers
+    ]
+    best = None
+    for substitution in itertools.product(*options):
+        wild_codes = [code for code in substitution if code is not None]
+        if len(set(wild_codes)) < len(wild_codes):
+            continue
+        for combination in itertools.combinations(codes + wild_codes, 5):
+            if hand_score(combination) == score:
+                candidate = sorted(card_name(code) for code in combination)
+                if best is None or candidate > best:
+                    best = candidate
+    return best
 
 
 def test_best_hand():
@@ -252,6 +532,61 @@ def test_best_hand():
     print('OK')
 
 
+def test_hand_rank():
+    print("test_hand_rank function..")
+    hands = [
+        "2C 3D 4H 5S 7C",  # набор карт
+        "2C 2D 4H 5S 7C",  # пара
+        "2C 2D 4H 4S 7C",  # две пары
+        "2C 2D 2H 4S 7C",  # сет
+        "6C 7D 8H 9S TC",  # стрит
+        "2C 3C 4C 5C 7C",  # флеш
+        "2C 2D 2H 4S 4C",  # фуллхаус
+        "2C 2D 2H 2S 7C",  # каре
+        "6C 7C 8C 9C TC",  # стритфлеш
+    ]
+    ranks = [hand_rank(hand.split()) for hand in hands]
+    assert (ranks == sorted(ranks) and len(set(ranks)) == len(ranks))
+    assert (hand_rank("AC KC QC JC 9C".split()) > hand_rank("AD KD QD JD 8D".split()))
+    assert (hand_rank("AC AD KH QS 3C".split()) > hand_rank("AH AS KC QD 2C".split()))
+    assert (hand_rank("AC AD KH QS 3C".split()) == hand_rank("AH AS KC QD 3D".split()))
+    assert (hand_rank("9C 9D 9H 2S 2C".split()) > hand_rank("8C 8D 8H AS AC".split()))
+    print('OK')
+
+
+def test_card_codes():
+    print("test_card_codes function..")
+    hand = "JD TC TH 7C 7D 7S 7H".split()
+    assert ([card_name(code) for code in hand_codes(hand)] == hand)
+    assert (hand_score(hand_codes("AC KC QC JC 9C".split())) == hand_rank("AC KC QC JC 9C".split()))
+    print('OK')
+
+
+def test_best_hand_scores():
+    print("test_best_hand_scores function..")
+    deck = list(_CARD_CODES)
+    hands = [random.Random(seed).sample(deck, BATCH_HAND_SIZE) for seed in range(300)]
+    hands.append("6C 7C 8C 9C TC 5C JC".split())
+    expected = [hand_rank(best_hand(hand)) for hand in hands]
+    assert ([best_score(hand_codes(hand)) for hand in hands] == expected)
+    assert (list(best_hand_scores(hands)) == expected)
+    codes = array.array("B", [code for hand in hands for code in hand_codes(hand)])
+    assert (list(best_hand_scores(codes)) == expected)
+    assert (list(best_hand_scores(codes.tobytes())) == expected)
+    if np is not None:
+        assert (best_hand_scores(np.array(codes).reshape(-1, BATCH_HAND_SIZE)).tolist() == expected)
+    bad_inputs = [codes[:-1], codes.tobytes()[:-3], hands[:2] + [hands[2][:6]]]
+    if np is not None:
+        bad_inputs += [np.array(codes), np.array(codes[:-7]).reshape(-1, 14)]
+    for bad_input in bad_inputs:
+        try:
+            best_hand_scores(bad_input)
+        except ValueError:
+            continue
+        raise AssertionError(f"{type(bad_input).__name__} of length {len(bad_input)} was not rejected")
+    print('OK')
+
+
 def test_best_wild_hand():
     print("test_best_wild_hand...")
     assert (sorted(best_wild_hand("6C 7C 8C 9C TC 5C ?B".split()))
@@ -263,6 +598,24 @@ def test_best_wild_hand():
     print('OK')
 
 
+def test_best_wild_hand_brute_force():
+    print("test_best_wild_hand_brute_force...")
+    rnd = random.Random(0)
+    deck = list(_CARD_CODES)
+    hands = ["AS AC KH 2D 3D 4D ?B".split(), "2C 3C 4C 5C 9H ?B ?R".split(), "AC KC QC JC 2H ?B ?R".split()]
+    for idx in range(40):
+        jokers = ["?B", "?R"] if idx % 2 else [rnd.choice(["?B", "?R"])]
+        hands.append(rnd.sample(deck, 7 - len(jokers)) + jokers)
+    for hand in hands:
+        wild = best_wild_hand(hand)
+        assert (wild == best_wild_hand_brute_force(hand))
+        substitutes = [card for card in wild if card not in hand]
+        assert (len(set(wild)) == 5 and len(substitutes) <= sum(card in JOKER_SUITS for card in hand))
+        for card in substitutes:
+            assert (any(_CARD_CODES[card] & 3 in JOKER_SUITS[joker] for joker in hand if joker in JOKER_SUITS))
+    print('OK')
+
+
 def test_flush():
     print("test_flush function..")
     assert (flush("6C 7C 8C 9C TC 5C".split()))
@@ -313,5 +666,9 @@ if __name__ == '__main__':
     test_straight()
     test_kind()
     test_two_pairs()
+    test_hand_rank()
+    test_card_codes()
     test_best_hand()
+    test_best_hand_scores()
     test_best_wild_hand()
+    test_best_wild_hand_brute_force()
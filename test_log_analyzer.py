@@ -1,9 +1,31 @@
+import concurrent.futures
+import csv
+import datetime
+import gzip
+import json
+import os
+import random
+import tempfile
 import time
+import typing as tp
 import unittest
+from unittest import mock
 
+import bench_log_analyzer
 import log_analyzer
 
 
+def _memory_limit_probe(log_name: str, limit: int) -> tp.Tuple[bool, bool]:
+    """В процессе с лимитом памяти: отображается ли файл больше лимита и упирается ли в лимит куча"""
+    with log_analyzer.MmapLogReader(log_name) as reader:
+        is_mapped = len(reader._mmap) > limit
+    try:
+        bytearray(limit)
+    except MemoryError:
+        return is_mapped, True
+    return is_mapped, False
+
+
 class TestSuite(unittest.TestCase):
     def test_log_info_parsing(self):
         test_row = ['1.126.153.80', '-', '-', '[29/Jun/2017:04:06:36 +0300]', 'GET /api/v2/banner/23964943 HTTP/1.1',
@@ -24,6 +46,58 @@ class TestSuite(unittest.TestCase):
         self.assertEqual(log_info.request_time, 0.609)
         self.assertEqual(log_info.request_clear(), "/api/v2/banner/23964943")
 
+    def test_log_line_parsing(self):
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" '
+                '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" '
+                '"dc7161be3" 0.390')
+        self.assertEqual(log_analyzer.parse_request_fields(line), ("/api/v2/banner/25019354", 0.39))
+        self.assertEqual(log_analyzer.parse_request_fields(line), log_analyzer.parse_request_fields_legacy(line))
+        log_info = log_analyzer.parse_log_line(line)
+        self.assertEqual(log_info.http_user_agent, "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5")
+        self.assertEqual(log_info.time_local, time.strptime("29/Jun/2017:03:50:22 +0300", "%d/%b/%Y:%H:%M:%S %z"))
+        self.assertEqual(log_info.request_time, 0.39)
+        with self.assertRaises(ValueError):
+            log_analyzer.parse_request_fields("broken line")
+
+    def test_malformed_lines(self):
+        with tempfile.NamedTemporaryFile() as file:
+            reader = log_analyzer.MmapLogReader(file.name)
+            reader.close()
+        for line in bench_log_analyzer.MALFORMED_LINES:
+            with self.subTest(line=line):
+                with self.assertRaises(AssertionError):
+                    log_analyzer.parse_request_fields_legacy(line)
+                with self.assertRaises((ValueError, IndexError)):
+                    log_analyzer.parse_request_fields(line)
+                with self.assertRaises((ValueError, IndexError)):
+                    reader.parse_request_fields(line.encode())
+                with self.assertRaises((ValueError, IndexError)):
+                    log_analyzer.parse_request_fields_timed(line)
+        line = bench_log_analyzer.generate_lines(1)[0]
+        self.assertEqual(log_analyzer.parse_request_fields(line), log_analyzer.parse_request_fields_legacy(line))
+        self.assertEqual(reader.parse_request_fields(line.encode()), log_analyzer.parse_request_fields(line))
+
+    def test_url_normalizer(self):
+        normalizer = log_analyzer.UrlNormalizer({
+            "strip_query": True,
+            "collapse_ids": True,
+            "collapse_uuids": True,
+            "collapse_hashes": True,
+            "templates": [[r"^/export/[^/]+\.csv$", "/export/{file}.csv"]],
+        })
+        self.assertEqual(normalizer.normalize("/api/v2/banner/23964943"), "/api/v2/banner/{id}")
+        self.assertEqual(normalizer.normalize("/api/v2/banner/23964943/?x=1"), "/api/v2/banner/{id}/")
+        self.assertEqual(normalizer.normalize("/api/1/slot/4705/groups"), "/api/{id}/slot/{id}/groups")
+        self.assertEqual(
+            normalizer.normalize("/agency/outlays/550e8400-e29b-41d4-a716-446655440000"), "/agency/outlays/{uuid}"
+        )
+        self.assertEqual(normalizer.normalize("/static/d41d8cd98f00b204e9800998ecf8427e.js"),
+                         "/static/d41d8cd98f00b204e9800998ecf8427e.js")
+        self.assertEqual(normalizer.normalize("/static/d41d8cd98f00b204e9800998ecf8427e"), "/static/{hash}")
+        self.assertEqual(normalizer.normalize("/export/2017-06.csv"), "/export/{file}.csv")
+        self.assertEqual(normalizer.normalize("/api/v2/banner"), "/api/v2/banner")
+        self.assertEqual(log_analyzer.UrlNormalizer({}).normalize("/api/1?x=2"), "/api/1?x=2")
+
     def test_stat_info_trivial(self):
         stat_info = log_analyzer.StatInfo("test")
         stat_info.append_time(1.0)
@@ -62,6 +136,683 @@ class TestSuite(unittest.TestCase):
         self.assertEqual(stat_info.request_times_avg(), 6.041666666666667)
         self.assertEqual(stat_info.request_times_median(), 5.5)
 
+    def test_stat_info_odd(self):
+        stat_info = log_analyzer.StatInfo("test")
+        stat_info.append_time(3.0)
+        self.assertEqual(stat_info.request_times_median(), 3.0)
+        stat_info.append_time(1.0)
+        stat_info.append_time(2.0)
+        self.assertEqual(stat_info.request_times_median(), 2.0)
+
+    def test_quantile_sketch(self):
+        rnd = random.Random(0)
+        times = [round(rnd.lognormvariate(-1.5, 1.0), 3) for _ in range(20000)] + [0.0] * 500
+        whole = log_analyzer.QuantileSketch()
+        first, second = log_analyzer.QuantileSketch(), log_analyzer.QuantileSketch()
+        for idx, request_time in enumerate(times):
+            whole.add(request_time)
+            (first if idx % 3 else second).add(request_time)
+        first.merge(second)
+        self.assertEqual(first.bins(), whole.bins())
+        self.assertEqual(first.count(), len(times))
+        sorted_times = sorted(times)
+        for q in (0.0, 0.01, 0.5, 0.9, 0.95, 0.99, 1.0):
+            exact = sorted_times[int(q * (len(times) - 1))]
+            self.assertLessEqual(abs(whole.quantile(q) - exact), exact * log_analyzer.SKETCH_RELATIVE_ACCURACY)
+        self.assertLess(len(whole.bins()), 1000)
+
+    def test_stat_info_without_times(self):
+        stat_info = log_analyzer.StatInfo("test", keep_times=False)
+        stat_info.append_time(0.5)
+        stat_info.append_time(2.0)
+        stat_info.append_time(1.5)
+        self.assertEqual(stat_info.count(), 3)
+        self.assertEqual(stat_info.request_times_sum(), 4.0)
+        self.assertEqual(stat_info.request_times_max(), 2.0)
+        with self.assertRaises(RuntimeError):
+            stat_info.request_times_median()
+
+    def test_stat_info_merge_without_times(self):
+        with_times = log_analyzer.StatInfo("test")
+        with_times.append_time(1.0)
+        frozen = log_analyzer.StatInfo.from_aggregate("test", 2, 5.0, 3.0, 2.5)
+        with self.assertRaises(ValueError):
+            with_times.merge(frozen)
+        with self.assertRaises(ValueError):
+            frozen.merge(with_times)
+        self.assertEqual((with_times.count(), with_times.request_times_median()), (1, 1.0))
+        with_times = log_analyzer.StatInfo("test", sketch=True)
+        frozen = log_analyzer.StatInfo("test", sketch=True)
+        for request_time in (1.0, 2.0, 3.0):
+            with_times.append_time(request_time)
+            frozen.append_time(request_time + 3.0)
+        frozen.freeze()
+        with_times.merge(frozen)
+        self.assertEqual(with_times.count(), 6)
+        self.assertEqual(with_times.request_times_sum(), 21.0)
+        median = with_times.request_times_median()  # по скетчу: элемент floor(0.5 * 5) = 3.0
+        self.assertLessEqual(abs(median - 3.0), 3.0 * log_analyzer.SKETCH_RELATIVE_ACCURACY)
+
+    def test_parallel_matches_serial(self):
+        lines = [
+            f'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/{idx % 7} HTTP/1.1" 200 927 "-" '
+            f'"-" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {idx % 13 * 0.117:.3f}'
+            for idx in range(1000)
+        ]
+        with tempfile.TemporaryDirectory() as folder:
+            log_name = os.path.join(folder, "nginx-access-ui.log-20170630")
+            with open(log_name, "w") as file:
+                file.write("\n".join(lines) + "\n")
+            serial = log_analyzer.process_log_file(log_name)
+            self.assertEqual(log_analyzer.process_log_file(log_name, workers=3), serial)
+            self.assertEqual(log_analyzer.process_log_file(log_name, workers=64), serial)
+            serial = log_analyzer.process_log_file(log_name, percentiles=True)
+            self.assertEqual(sorted(serial[0][0]), [
+                "count", "count_perc", "time_avg", "time_max", "time_med", "time_p90", "time_p95", "time_p99",
+                "time_perc", "time_sum", "url",
+            ])
+            self.assertEqual(log_analyzer.process_log_file(log_name, workers=3, percentiles=True), serial)
+
+    @unittest.skipIf(log_analyzer.np is None, "numpy is not installed")
+    def test_numpy_backend(self):
+        rnd = random.Random(0)
+        lines = [
+            f'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/{rnd.randint(0, 50)} HTTP/1.1" '
+            f'200 927 "-" "-" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {rnd.lognormvariate(-1.5, 1.0):.3f}'
+            for _ in range(5000)
+        ] + ["broken"]
+        with tempfile.TemporaryDirectory() as folder:
+            for log_name in ("nginx-access-ui.log-20170630", "nginx-access-ui.log-20170630.gz"):
+                log_name = os.path.join(folder, log_name)
+                with (gzip.open if log_name.endswith(".gz") else open)(log_name, "wt") as file:
+                    file.write("\n".join(lines) + "\n")
+                with self.assertLogs(level="ERROR"):
+                    expected = log_analyzer.process_log_file(log_name)
+                with self.assertLogs(level="ERROR"):
+                    self.assertEqual(log_analyzer.process_log_file(log_name, backend="numpy"), expected)
+
+    def test_backend_fallback(self):
+        with mock.patch.object(log_analyzer, "np", None):
+            with self.assertLogs(level="WARNING"):
+                self.assertEqual(log_analyzer.resolve_aggregation_backend("numpy"), "python")
+        self.assertEqual(log_analyzer.resolve_aggregation_backend("python"), "python")
+        with self.assertRaises(ValueError):
+            log_analyzer.resolve_aggregation_backend("pandas")
+
+    def test_gzip_pipeline(self):
+        lines = [f"line {idx}" for idx in range(50000)]
+        with tempfile.TemporaryDirectory() as folder:
+            log_name = os.path.join(folder, "nginx-access-ui.log-20170630.gz")
+            with gzip.open(log_name, "wt") as file:
+                file.write("\n".join(lines[:20000]) + "\n")
+            with gzip.open(log_name, "at") as file:  # второй gzip member
+                file.write("\n".join(lines[20000:]))
+            self.assertEqual(list(log_analyzer._read_gzip_log(log_name, queue_size=1)), lines)
+            reader = log_analyzer._read_gzip_log(log_name, queue_size=1)
+            self.assertEqual(next(reader), "line 0")
+            reader.close()
+            with open(log_name, "ab") as file:  # выравнивание нулями после member, как у ленточных архивов
+                file.write(b"\x00" * 1000)
+            with gzip.open(log_name, "at") as file:
+                file.write("\nline tail")
+            with open(log_name, "ab") as file:
+                file.write(b"\x00" * 10)
+            expected = lines + ["line tail"]
+            with gzip.open(log_name, "rt") as file:
+                self.assertEqual(file.read().split("\n"), expected)
+            self.assertEqual(list(log_analyzer._read_gzip_log(log_name, queue_size=1)), expected)
+            batches = log_analyzer._gzip_line_batches(log_name, block_size=7)  # нули попадают на границу блоков
+            self.assertEqual(b"\n".join(batches).decode().split("\n"), expected)
+
+    def test_mmap_reader(self):
+        lines = [
+            '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 927 "-" "-" "-" '
+            '"1498697422-2190034393-4708-9752759" "dc7161be3" 0.390',
+            'broken line',
+            '',
+            '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 927 "-" "-" "-" '
+            '"1498697422-2190034393-4708-9752759" "dc7161be3" 0.610\r',
+        ]
+        with tempfile.TemporaryDirectory() as folder:
+            log_name = os.path.join(folder, "nginx-access-ui.log-20170630")
+            with open(log_name, "w") as file:
+                file.write("\n".join(lines))
+            with self.assertLogs(level="ERROR"):
+                with log_analyzer.MmapLogReader(log_name) as reader:
+                    stat_info, error_count = log_analyzer.process_log_info(reader, reader.parse_request_fields)
+        self.assertEqual(error_count, 2)
+        self.assertEqual(list(stat_info), ["/api/v2/banner/1"])
+        self.assertEqual(stat_info["/api/v2/banner/1"].request_times_sum(), 1.0)
+
+    def test_mmap_reader_url_cache_bound(self):
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/{} HTTP/1.1" 200 927 "-" "-" "-" '
+                '"1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n')
+        normalizer = log_analyzer.UrlNormalizer({"collapse_ids": True, "cache_size": 100})
+        with tempfile.TemporaryDirectory() as folder:
+            log_name = os.path.join(folder, "nginx-access-ui.log-20170630")
+            with open(log_name, "w") as file:
+                file.write("".join(line.format(idx) for idx in range(3000)))
+            with log_analyzer.MmapLogReader(log_name, url_normalizer=normalizer) as reader:
+                stat_info, _ = log_analyzer.process_log_info(reader, reader.parse_request_fields)
+                self.assertLessEqual(len(reader._urls), 100)  # кэш сырых $request не растет с числом url
+            self.assertEqual(list(stat_info), ["/api/v2/banner/{id}"])
+            self.assertEqual(stat_info["/api/v2/banner/{id}"].count(), 3000)
+            range_info, _ = log_analyzer._process_log_range(log_name, 0, os.path.getsize(log_name), normalizer)
+            text_info, _ = log_analyzer.process_log_info(log_analyzer._read_log(log_name), url_normalizer=normalizer)
+            self.assertEqual(log_analyzer.calculate_stat_info(range_info), log_analyzer.calculate_stat_info(text_info))
+
+    def test_incremental_checkpoint(self):
+        lines = [
+            f'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/{idx % 5} HTTP/1.1" 200 927 "-" '
+            f'"-" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {idx % 11 * 0.131:.3f}\n'
+            for idx in range(300)
+        ]
+        with tempfile.TemporaryDirectory() as folder:
+            log_name = os.path.join(folder, "nginx-access-ui.log-20170630")
+            checkpoint_path = os.path.join(folder, "checkpoints", "nginx-access-ui.log-20170630.checkpoint")
+            with open(log_name, "w") as file:
+                file.write("".join(lines[:100]) + lines[100][:40])  # последняя строка еще дописывается
+            stat_info, error_count = log_analyzer.process_log_file(log_name, checkpoint_path=checkpoint_path)
+            self.assertEqual(sum(row["count"] for row in stat_info), 100)
+            self.assertEqual(error_count, 0)
+            with mock.patch.object(log_analyzer.pickle, "load", wraps=log_analyzer.pickle.load) as load:
+                self.assertTrue(log_analyzer.is_checkpoint_current(log_name, checkpoint_path))
+            self.assertEqual(load.call_count, 1)  # только заголовок, без агрегатов
+            self.assertNotIn("stat_info", log_analyzer.load_checkpoint(checkpoint_path, with_stat_info=False))
+            with open(log_name, "a") as file:
+                file.write(lines[100][40:] + "".join(lines[101:]))
+            self.assertFalse(log_analyzer.is_checkpoint_current(log_name, checkpoint_path))
+            self.assertEqual(log_analyzer.load_checkpoint(checkpoint_path)["offset"], len("".join(lines[:100])))
+            incremental = log_analyzer.process_log_file(log_name, checkpoint_path=checkpoint_path)
+            self.assertEqual(incremental, log_analyzer.process_log_file(log_name))
+            with open(log_name, "w") as file:  # copytruncate и новые записи
+                file.write("".join(reversed(lines)))
+            incremental = log_analyzer.process_log_file(log_name, checkpoint_path=checkpoint_path)
+            self.assertEqual(incremental, log_analyzer.process_log_file(log_name))
+
+    def test_backfill(self):
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 927 "-" "-" "-" '
+                '"1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n')
+        with tempfile.TemporaryDirectory() as folder:
+            log_folder = os.path.join(folder, "log")
+            report_folder = os.path.join(folder, "reports")
+            os.makedirs(log_folder)
+            with open(os.path.join(log_folder, "nginx-access-ui.log-29062017"), "w") as file:
+                file.write(line * 10)
+            with gzip.open(os.path.join(log_folder, "nginx-access-ui.log-30062017.gz"), "wt") as file:
+                file.write(line * 10)
+            with open(os.path.join(log_folder, "nginx-access-ui.log-01072017"), "w") as file:
+                file.write(line + "broken\n" * 5)
+            with self.assertLogs(level="INFO"):
+                summary = log_analyzer.backfill_folder(log_folder, report_folder, 0.4, workers=2)
+            self.assertEqual(
+                {log_name: is_created for log_name, (is_created, _) in summary.items()},
+                {
+                    "nginx-access-ui.log-29062017": True,
+                    "nginx-access-ui.log-30062017.gz": True,
+                    "nginx-access-ui.log-01072017": False,
+                },
+            )
+            self.assertEqual(len(os.listdir(report_folder)), 2)
+            with self.assertLogs(level="INFO"):
+                summary = log_analyzer.backfill_folder(log_folder, report_folder, 0.4, workers=2)
+            self.assertEqual(list(summary), ["nginx-access-ui.log-01072017"])
+
+    @unittest.skipUnless(log_analyzer.resource is not None and os.path.exists("/proc/self/status"), "needs Linux")
+    def test_backfill_memory_limit(self):
+        with open("/proc/self/status") as file:
+            data_mb = next(int(line.split()[1]) // 1024 for line in file if line.startswith("VmData:"))
+        memory_limit_mb = data_mb + 64  # процесс разбора - форк текущего и начинает с его данных
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 927 "-" "-" "-" '
+                '"1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n')
+        with tempfile.TemporaryDirectory() as folder:
+            sparse_log = os.path.join(folder, "sparse.log")
+            with open(sparse_log, "w") as file:  # разреженный файл больше лимита, на диске - килобайты
+                file.truncate(2 * memory_limit_mb * 1024 * 1024)
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1, initializer=log_analyzer._limit_worker_memory, initargs=(memory_limit_mb,)
+            ) as executor:
+                probe = executor.submit(_memory_limit_probe, sparse_log, memory_limit_mb * 1024 * 1024)
+                self.assertEqual(probe.result(), (True, True))
+            log_folder = os.path.join(folder, "log")
+            os.makedirs(log_folder)
+            with open(os.path.join(log_folder, "nginx-access-ui.log-29062017"), "w") as file:
+                file.write(line * 10)
+            with self.assertLogs(level="INFO"):
+                summary = log_analyzer.backfill_folder(
+                    log_folder, os.path.join(folder, "reports"), 0.4, memory_limit_mb=memory_limit_mb
+                )
+            self.assertTrue(summary["nginx-access-ui.log-29062017"][0], summary)
+
+    def test_aggregate_cache(self):
+        lines = [
+            f'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/{idx % 7}/ы HTTP/1.1" 200 927 "-" '
+            f'"-" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {idx % 13 * 0.117:.3f}\n'
+            for idx in range(500)
+        ]
+        with tempfile.TemporaryDirectory() as folder:
+            log_name = os.path.join(folder, "nginx-access-ui.log-20170630")
+            cache_path = os.path.join(folder, "cache", "nginx-access-ui.log-20170630.agg")
+            with open(log_name, "w") as file:
+                file.write("".join(lines[:400]) + "broken\n")
+            with self.assertLogs(level="ERROR"):
+                expected = log_analyzer.process_log_file(log_name, cache_path=cache_path)
+            self.assertEqual(expected, log_analyzer.process_log_file(log_name))
+            self.assertEqual(log_analyzer.load_aggregate_cache(cache_path, log_name)[1], 1)
+            self.assertEqual(log_analyzer.process_log_file(log_name, cache_path=cache_path), expected)
+            with_percentiles = log_analyzer.process_log_file(log_name, percentiles=True)
+            percentiles_cache_path = f"{cache_path}.pct"
+            with self.assertLogs(level="ERROR"):
+                log_analyzer.process_log_file(log_name, cache_path=percentiles_cache_path, percentiles=True)
+            self.assertEqual(
+                log_analyzer.process_log_file(log_name, cache_path=percentiles_cache_path, percentiles=True),
+                with_percentiles,
+            )
+            with open(log_name, "a") as file:
+                file.write("".join(lines[400:]))
+            with self.assertLogs(level="INFO"):
+                self.assertIsNone(log_analyzer.load_aggregate_cache(cache_path, log_name))
+                self.assertEqual(
+                    log_analyzer.process_log_file(log_name, cache_path=cache_path),
+                    log_analyzer.process_log_file(log_name),
+                )
+
+    def test_top_report_rows(self):
+        stat_info = {}
+        for idx in range(200):
+            request = f"/api/{idx}"
+            stat_info[request] = log_analyzer.StatInfo(request)
+            for time_idx in range(idx % 9 + 1):
+                stat_info[request].append_time(0.1 * (idx % 17) + time_idx)
+        rows = log_analyzer.calculate_stat_info(stat_info)
+        self.assertEqual(rows, sorted(rows, key=lambda row: row["time_perc"], reverse=True))
+        self.assertEqual(log_analyzer.calculate_stat_info(stat_info, 15), rows[:15])
+        self.assertEqual(log_analyzer.calculate_stat_info(stat_info, 1000), rows)
+
+    def test_top_report_rows_unrounded(self):
+        stat_info = {}
+        for request, request_time in (("/light", 1.0), ("/heavy", 1.0004), ("/rest", 10000.0)):
+            stat_info[request] = log_analyzer.StatInfo(request)
+            stat_info[request].append_time(request_time)
+        rows = log_analyzer.calculate_stat_info(stat_info, 2)
+        self.assertEqual([row["url"] for row in rows], ["/rest", "/heavy"])
+        rows = log_analyzer.calculate_stat_info(stat_info)
+        self.assertEqual([row["url"] for row in rows], ["/rest", "/heavy", "/light"])
+
+    def test_metrics_file(self):
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 927 "-" "-" "-" '
+                '"1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n')
+        with tempfile.TemporaryDirectory() as folder:
+            log_folder = os.path.join(folder, "log")
+            report_folder = os.path.join(folder, "reports")
+            os.makedirs(log_folder)
+            with open(os.path.join(log_folder, "nginx-access-ui.log-29062017"), "w") as file:
+                file.write(line * 9 + "broken\n")
+            with self.assertLogs(level="ERROR"):
+                log_analyzer.process_folder(log_folder, report_folder, 1.0, 10, write_metrics=True)
+            reports = sorted(os.listdir(report_folder))
+            self.assertEqual(len(reports), 2)
+            with open(os.path.join(report_folder, reports[1])) as file:
+                metrics = json.load(file)
+        self.assertTrue(reports[1].endswith(".metrics.json"))
+        self.assertEqual(set(metrics["stages"]), {"discovery", "aggregate", "stats", "render"})
+        self.assertEqual(metrics["lines"], 10)
+        self.assertEqual(metrics["error_count"], 1)
+        self.assertEqual(metrics["url_count"], 1)
+        self.assertEqual(metrics["bytes"], len(line) * 9 + 7)
+        self.assertEqual(metrics["parsed_lines"], 10)
+
+    def test_metrics_throughput(self):
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 927 "-" "-" "-" '
+                '"1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n')
+        with tempfile.TemporaryDirectory() as folder:
+            log_name = os.path.join(folder, "nginx-access-ui.log-29062017")
+            html_save = os.path.join(folder, "report-2017.06.29.html")
+            with open(log_name, "w") as file:
+                file.write(line * 10)
+            cache_path = os.path.join(folder, "cache.agg")
+            checkpoint_path = os.path.join(folder, "log.checkpoint")
+            for _ in range(2):
+                log_analyzer.build_report(
+                    log_name, html_save, 0.4, cache_path=cache_path, metrics=log_analyzer.Metrics()
+                )
+                log_analyzer.build_report(
+                    log_name, html_save, 0.4, checkpoint_path=checkpoint_path, metrics=log_analyzer.Metrics()
+                )
+            metrics = log_analyzer.Metrics()
+            log_analyzer.build_report(log_name, html_save, 0.4, cache_path=cache_path, metrics=metrics)
+            self.assertEqual((metrics.counters["lines"], metrics.counters["parsed_lines"]), (10, 0))
+            self.assertNotIn("lines_per_sec", metrics.to_dict())  # из кэша ничего не разбиралось
+            with open(log_name, "a") as file:
+                file.write(line * 3)
+            metrics = log_analyzer.Metrics()
+            log_analyzer.build_report(log_name, html_save, 0.4, checkpoint_path=checkpoint_path, metrics=metrics)
+            self.assertEqual(metrics.counters["lines"], 13)
+            self.assertEqual((metrics.counters["parsed_lines"], metrics.counters["parsed_bytes"]), (3, len(line) * 3))
+
+    def test_error_budget(self):
+        self.assertLess(log_analyzer.error_ratio_lower_bound(500, 1000), 0.5)
+        self.assertGreater(log_analyzer.error_ratio_lower_bound(500, 1000), 0.4)
+        self.assertEqual(log_analyzer.error_ratio_lower_bound(0, 1000), 0.0)
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 927 "-" "-" "-" '
+                '"1498697422-2190034393-4708-9752759" "dc7161be3" 0.390')
+        lines = iter([line, "broken"] * 50000)
+        with self.assertLogs(level="ERROR") as logs:
+            with self.assertRaises(log_analyzer.ErrorBudgetExceeded):
+                log_analyzer.process_log_info(lines, error_budget=log_analyzer.ErrorBudget(0.4))
+        self.assertEqual(len(logs.output), log_analyzer.ERROR_SAMPLE_FIRST)
+        self.assertEqual(sum(1 for _ in lines), 99000)  # остановка на ERROR_BUDGET_MIN_LINES строках
+        with self.assertLogs(level="WARNING") as logs:
+            stat_info, error_count = log_analyzer.process_log_info(
+                [line, "broken", "", line], error_budget=log_analyzer.ErrorBudget(0.4)
+            )
+        self.assertEqual(error_count, 2)
+        self.assertIn("2 bad lines (ValueError: 2)", logs.output[-1])
+        with tempfile.TemporaryDirectory() as folder:
+            log_name = os.path.join(folder, "nginx-access-ui.log-20170630")
+            with open(log_name, "w") as file:
+                file.write(f"{line}\nbroken\n" * 50000)
+            with mock.patch.object(log_analyzer.logging, "error"):  # выборка ошибок пишется в процессах участков
+                with self.assertRaises(log_analyzer.ErrorBudgetExceeded):
+                    log_analyzer.aggregate_log_file(log_name, workers=2, max_error_ratio=0.4)
+                with self.assertRaises(log_analyzer.ErrorBudgetExceeded):
+                    log_analyzer.process_log_info_parallel(log_name, 2, max_error_ratio=0.4)
+
+    def test_create_html_file(self):
+        rows = [{"url": "/api/</script>", "count": 1}, {"url": "/api/ы", "count": 2}]
+
+        def broken_rows():
+            yield rows[0]
+            raise RuntimeError("crash while rendering")
+
+        with tempfile.TemporaryDirectory() as folder:
+            html_save = os.path.join(folder, "reports", "report-2017.06.30.html")
+            with self.assertRaises(RuntimeError):
+                log_analyzer.create_html_file(html_save, broken_rows())
+            self.assertEqual(os.listdir(os.path.dirname(html_save)), [])
+            log_analyzer.create_html_file(html_save, iter(rows))
+            with open(html_save, encoding="utf8") as file:
+                html = file.read()
+        self.assertNotIn("</script>,", html)
+        table = html[html.index("var table = ") + len("var table = "):html.index(";\n    var reportDates")]
+        self.assertEqual(json.loads(table), rows)
+
+    def test_log_discovery(self):
+        with tempfile.TemporaryDirectory() as folder:
+            log_folder = os.path.join(folder, "log")
+            index_path = os.path.join(folder, "index.json")
+            os.makedirs(os.path.join(log_folder, "nginx-access-ui.log-31122099"))  # папка, а не лог
+            names = (
+                "nginx-access-ui.log-30062017.gz", "nginx-access-ui.log-01072017", "nginx-access-ui.log-31122016",
+                "nginx-access-ui.log-32012018", "nginx-access-ui.log-01072017.bz2",
+            )
+            for name in names:
+                open(os.path.join(log_folder, name), "w").close()
+            self.assertEqual(
+                log_analyzer.provide_last_log_path_and_date(log_folder),
+                ("nginx-access-ui.log-01072017", "2017.07.01"),
+            )
+            self.assertEqual(
+                log_analyzer.provide_all_logs_and_dates(log_folder, index_path),
+                [
+                    ("nginx-access-ui.log-31122016", "2016.12.31"),
+                    ("nginx-access-ui.log-30062017.gz", "2017.06.30"),
+                    ("nginx-access-ui.log-01072017", "2017.07.01"),
+                ],
+            )
+            with open(index_path) as file:
+                self.assertEqual(len(json.load(file)["logs"]), 3)
+            open(os.path.join(log_folder, "nginx-access-ui.log-02072017.gz"), "w").close()
+            self.assertEqual(
+                log_analyzer.provide_last_log_path_and_date(log_folder, index_path),
+                ("nginx-access-ui.log-02072017.gz", "2017.07.02"),
+            )
+
+    def test_watch(self):
+        lines = [
+            f'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/{idx % 5} HTTP/1.1" 200 927 "-" '
+            f'"-" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {idx % 11 * 0.131:.3f}\n'
+            for idx in range(300)
+        ]
+        with tempfile.TemporaryDirectory() as folder:
+            log_folder = os.path.join(folder, "log")
+            report_folder = os.path.join(folder, "reports")
+            checkpoint_folder = os.path.join(folder, "checkpoints")
+            os.makedirs(log_folder)
+            log_name = os.path.join(log_folder, "nginx-access-ui.log-29062017")
+            with open(log_name, "w") as file:
+                file.write("".join(lines[:100]) + lines[100][:40])
+            watcher = log_analyzer.LogWatcher(log_folder, report_folder, 0.4, checkpoint_folder=checkpoint_folder)
+            with self.assertLogs(level="INFO"):
+                watcher.poll_folder()
+                self.assertTrue(watcher.poll_log())
+                self.assertFalse(watcher.poll_log())
+                self.assertTrue(watcher.write_report())
+                self.assertFalse(watcher.write_report())
+            self.assertEqual(sum(row["count"] for row in watcher.report_rows()), 100)
+            with open(log_name, "a") as file:
+                file.write(lines[100][40:] + "".join(lines[101:200]))
+            self.assertTrue(watcher.poll_log())
+            self.assertEqual(watcher.report_rows(), log_analyzer.process_log_file(log_name)[0])
+
+            restarted = log_analyzer.LogWatcher(log_folder, report_folder, 0.4, checkpoint_folder=checkpoint_folder)
+            with self.assertLogs(level="INFO"):
+                restarted.poll_folder()
+            self.assertEqual(sum(row["count"] for row in restarted.report_rows()), 100)
+
+            with open(log_name, "a") as file:
+                file.write("".join(lines[200:]))
+            with open(os.path.join(log_folder, "nginx-access-ui.log-30062017"), "w") as file:
+                file.write(lines[1])
+            os.utime(log_folder, ns=(0, 0))  # время папки точно изменилось
+            with self.assertLogs(level="INFO"):
+                watcher.poll_folder()
+            self.assertEqual(watcher.date_str, "2017.06.30")
+            self.assertEqual(sorted(os.listdir(report_folder)), ["report-2017.06.29.html"])
+            self.assertEqual(log_analyzer.load_checkpoint(
+                os.path.join(checkpoint_folder, "nginx-access-ui.log-29062017.checkpoint"))["offset"],
+                os.path.getsize(log_name),
+            )
+            self.assertTrue(watcher.poll_log())
+            self.assertEqual(sum(row["count"] for row in watcher.report_rows()), 1)
+
+    def test_time_series(self):
+        for time_local in ("29/Jun/2017:03:50:22 +0300", "01/Jan/2016:00:00:00 -0130", "31/Dec/2017:23:59:59 +0000"):
+            parsed = datetime.datetime.strptime(time_local, log_analyzer.TIME_LOCAL_FORMAT)
+            self.assertEqual(
+                log_analyzer.time_of_day_seconds(time_local), parsed.hour * 3600 + parsed.minute * 60 + parsed.second
+            )
+        with self.assertRaises(ValueError):
+            log_analyzer.time_of_day_seconds("29/Jun/2017 03:50:22 +0300")
+        lines = [
+            f'1.196.116.32 -  - [29/Jun/2017:{hour:02d}:{minute:02d}:22 +0300] '
+            f'"GET /api/v2/banner/{hour % 2} HTTP/1.1" 200 927 "-" "-" "-" "1498697422-2190034393-4708-9752759" '
+            f'"dc7161be3" {hour * 0.1 + minute * 0.001:.3f}'
+            for hour in (4, 20, 21) for minute in (0, 4, 5)
+        ] + ["broken"]
+        with self.assertLogs(level="ERROR"):
+            time_series, error_count = log_analyzer.process_time_series(lines, 300)
+        self.assertEqual(error_count, 1)
+        self.assertEqual(time_series.urls(), ["/api/v2/banner/0", "/api/v2/banner/1"])
+        top_series, _ = log_analyzer.process_time_series(lines[:-1], 300, urls=["/api/v2/banner/0"])
+        self.assertEqual(top_series.urls(), ["/api/v2/banner/0"])
+        self.assertEqual(list(top_series.rows(["/api/v2/banner/0"])), list(time_series.rows(["/api/v2/banner/0"])))
+        self.assertEqual(list(time_series.rows(["/api/v2/banner/0", "/missing"])), [
+            {"url": "/api/v2/banner/0", "bucket": "04:00", "count": 2, "time_sum": 0.804, "time_avg": 0.402,
+             "time_max": 0.404},
+            {"url": "/api/v2/banner/0", "bucket": "04:05", "count": 1, "time_sum": 0.405, "time_avg": 0.405,
+             "time_max": 0.405},
+            {"url": "/api/v2/banner/0", "bucket": "20:00", "count": 2, "time_sum": 4.004, "time_avg": 2.002,
+             "time_max": 2.004},
+            {"url": "/api/v2/banner/0", "bucket": "20:05", "count": 1, "time_sum": 2.005, "time_avg": 2.005,
+             "time_max": 2.005},
+        ])
+        with tempfile.TemporaryDirectory() as folder:
+            log_name = os.path.join(folder, "nginx-access-ui.log-29062017")
+            html_save = os.path.join(folder, "report-2017.06.29.html")
+            with open(log_name, "w") as file:
+                file.write("\n".join(lines) + "\n")
+            with self.assertLogs(level="ERROR") as logs:
+                is_created, _ = log_analyzer.build_report(log_name, html_save, 0.4, time_bucket="1h", time_series_top=1)
+            self.assertTrue(is_created)
+            self.assertEqual(sum("bad line" in message for message in logs.output), 1)  # второй проход не пишет в лог
+            with open(log_analyzer.time_series_file_path(html_save), encoding="utf8") as file:
+                table = list(csv.DictReader(file))
+        self.assertEqual([(row["url"], row["bucket"], row["count"]) for row in table], [
+            ("/api/v2/banner/0", "04:00", "3"),
+            ("/api/v2/banner/0", "20:00", "3"),
+        ])
+
+    def test_multi_source(self):
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/{} HTTP/1.1" 200 927 "-" "-" "-" '
+                '"1498697422-2190034393-4708-9752759" "dc7161be3" {:.3f}\n')
+        lines = [line.format(idx % 4, idx % 9 * 0.21) for idx in range(90)]
+        with tempfile.TemporaryDirectory() as folder:
+            sources = [os.path.join(folder, name) for name in ("web1", "web2", "web3", "web4", "web5")]
+            report_folder = os.path.join(folder, "reports")
+            for source in sources[:4]:
+                os.makedirs(source)
+            with open(os.path.join(sources[0], "nginx-access-ui.log-30062017"), "w") as file:
+                file.write("".join(lines[:30]))
+            with gzip.open(os.path.join(sources[1], "nginx-access-ui.log-30062017.gz"), "wt") as file:
+                file.write("".join(lines[30:]))
+            with open(os.path.join(sources[2], "nginx-access-ui.log-30062017"), "w") as file:
+                file.write("broken\n" * 10)
+            with open(os.path.join(sources[3], "nginx-access-ui.log-29062017"), "w") as file:
+                file.write("".join(lines))
+            combined = os.path.join(folder, "combined.log")
+            with open(combined, "w") as file:
+                file.write("".join(lines))
+            with self.assertLogs(level="INFO"):
+                summary = log_analyzer.process_sources(sources, report_folder, 0.4)
+            self.assertEqual(
+                [(source.status, source.lines, source.errors) for source in summary.values()],
+                [("ok", 30, 0), ("ok", 60, 0), ("too many errors", 10, 10), ("missing", 0, 0), ("missing", 0, 0)],
+            )
+            html_save = os.path.join(report_folder, "report-2017.06.30.html")
+            with open(html_save, encoding="utf8") as file:
+                html = file.read()
+            table = html[html.index("var table = ") + len("var table = "):html.index(";\n    var reportDates")]
+            self.assertEqual(json.loads(table), log_analyzer.process_log_file(combined)[0])
+            with open(log_analyzer.sources_file_path(html_save)) as file:
+                self.assertEqual([source["status"] for source in json.load(file)][:3], ["ok", "ok", "too many errors"])
+            self.assertIn(f"{sources[2]}: too many errors, 10 lines, 10 errors", html)
+
+            broken_report_folder = os.path.join(folder, "broken_reports")
+            with self.assertLogs(level="ERROR"):
+                summary = log_analyzer.process_sources(sources[2:], broken_report_folder, 0.4)
+            self.assertEqual([source.status for source in summary.values()], ["too many errors", "missing", "missing"])
+            self.assertEqual(os.listdir(broken_report_folder), ["report-2017.06.30.sources.json"])
+
+            config_path = os.path.join(folder, "config.json")
+            with open(config_path, "w") as file:
+                json.dump({"LOG_DIR": sources[:2], "REPORT_DIR": os.path.join(folder, "config_reports"),
+                           "CACHE_DIR": os.path.join(folder, "cache"), "TIME_BUCKET": "1h"}, file)
+            with self.assertLogs(level="WARNING") as logs:
+                log_analyzer.main([config_path])
+            self.assertEqual(logs.output, [
+                "WARNING:root:CACHE_DIR is ignored when LOG_DIR is a list",
+                "WARNING:root:TIME_BUCKET is ignored when LOG_DIR is a list",
+            ])
+            self.assertFalse(os.path.exists(os.path.join(folder, "cache")))
+
+    def test_history(self):
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/{} HTTP/1.1" 200 927 "-" "-" "-" '
+                '"1498697422-2190034393-4708-9752759" "dc7161be3" {:.3f}\n')
+        with tempfile.TemporaryDirectory() as folder:
+            log_folder = os.path.join(folder, "log")
+            report_folder = os.path.join(folder, "reports")
+            history_db = os.path.join(folder, "history", "history.sqlite")
+            os.makedirs(log_folder)
+            for day in (28, 29, 30):
+                with open(os.path.join(log_folder, f"nginx-access-ui.log-{day}062017"), "w") as file:
+                    file.write("".join(line.format(idx % 3, day / 100 + idx * 0.01) for idx in range(day)))
+            with self.assertLogs(level="INFO"):
+                log_analyzer.backfill_folder(log_folder, report_folder, 0.4, workers=2, history_db=history_db)
+            log_name = os.path.join(log_folder, "nginx-access-ui.log-30062017")
+            for _ in range(2):  # повторный разбор дня не дублирует строки
+                is_created, _ = log_analyzer.build_report(
+                    log_name, os.path.join(folder, "again.html"), 0.4, history_db=history_db, percentiles=True
+                )
+                self.assertTrue(is_created)
+            june = (datetime.date(2017, 6, 1), datetime.date(2017, 6, 30))
+            trend = log_analyzer.history_trend(history_db, "/api/v2/banner/0", *june)
+            self.assertEqual([row["date"] for row in trend], ["2017-06-28", "2017-06-29", "2017-06-30"])
+            self.assertEqual([row["count"] for row in trend], [10, 10, 10])
+            self.assertIn("time_p99", trend[-1])
+            self.assertNotIn("time_p99", trend[0])
+            rows = log_analyzer.history_report_rows(history_db, *june, report_size=2)
+            self.assertEqual(len(rows), 2)
+            self.assertEqual(sum(row["count"] for row in log_analyzer.history_report_rows(history_db, *june)), 87)
+            daily_rows = [
+                row
+                for log_name in sorted(os.listdir(log_folder))
+                for row in log_analyzer.process_log_file(os.path.join(log_folder, log_name))[0]
+            ]
+            for row in rows:
+                url_rows = [daily_row for daily_row in daily_rows if daily_row["url"] == row["url"]]
+                self.assertAlmostEqual(row["time_sum"], sum(url_row["time_sum"] for url_row in url_rows))
+                self.assertEqual(row["time_max"], max(url_row["time_max"] for url_row in url_rows))
+                self.assertEqual(row["time_med_max"], max(url_row["time_med"] for url_row in url_rows))
+            self.assertGreater(rows[0]["time_sum"], rows[1]["time_sum"])
+            self.assertIsNone(log_analyzer.build_history_report(history_db, report_folder, june[0], june[0]))
+            html_save = log_analyzer.build_history_report(history_db, report_folder, *june)
+            self.assertEqual(os.path.basename(html_save), "report-2017.06.01-2017.06.30.html")
+
+    def test_regression_report(self):
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/{} HTTP/1.1" 200 927 "-" "-" "-" '
+                '"1498697422-2190034393-4708-9752759" "dc7161be3" {:.3f}\n')
+        days = {
+            27: [(1, 20, 0.2)],
+            28: [(0, 20, 0.1), (1, 20, 0.1), (2, 5, 0.1)],
+            29: [(0, 20, 0.1), (1, 20, 0.3), (2, 5, 1.0), (3, 12, 0.2)],
+        }
+        with tempfile.TemporaryDirectory() as folder:
+            log_folder = os.path.join(folder, "log")
+            cache_folder = os.path.join(folder, "cache")
+            history_db = os.path.join(folder, "history.sqlite")
+            os.makedirs(log_folder)
+            for day, urls in days.items():
+                with open(os.path.join(log_folder, f"nginx-access-ui.log-{day}062017"), "w") as file:
+                    file.write("".join(line.format(url, time) for url, count, time in urls for _ in range(count)))
+            dates = [datetime.date(2017, 6, day) for day in days]
+            missing = dates + [datetime.date(2017, 6, 26)]
+            with self.assertLogs(level="INFO"):
+                unknown = log_analyzer.fill_history(
+                    history_db, log_folder, missing, 0.4, cache_folder=cache_folder, percentiles=True
+                )
+            self.assertEqual(unknown, [datetime.date(2017, 6, 26)])
+            trend = log_analyzer.history_trend(history_db, "/api/v2/banner/1", dates[0], dates[-1])
+            self.assertEqual(len(trend), 3)
+            self.assertTrue(all(row["time_p90"] is not None for row in trend))
+            self.assertTrue(any(name.endswith(".pct.agg") for name in os.listdir(cache_folder)))
+            with mock.patch.object(log_analyzer, "aggregate_log_file") as aggregate:  # уже в базе - логи не нужны
+                log_analyzer.fill_history(history_db, log_folder, dates, 0.4, cache_folder=cache_folder)
+            aggregate.assert_not_called()
+
+            rows = log_analyzer.regression_rows(history_db, dates[1:])
+            self.assertEqual([row["url"] for row in rows], ["/api/v2/banner/1", "/api/v2/banner/3"])
+            self.assertAlmostEqual(rows[0]["time_sum_delta"], 4.0)
+            self.assertEqual(rows[0]["time_avg_ratio"], 3.0)
+            self.assertEqual(rows[0]["time_med_base"], 0.1)
+            self.assertIsNone(rows[1]["time_sum_ratio"])
+            self.assertEqual(rows[1]["count_base"], 0)
+            self.assertEqual(len(log_analyzer.regression_rows(history_db, dates[1:], report_size=1)), 1)
+            thresholds = {"time_avg": 3.0, "min_count": 15}
+            self.assertEqual(log_analyzer.regression_rows(history_db, dates[1:], thresholds), [])
+
+            # база - среднее по 27 и 28: banner/0 был только 28-го, его time_sum на день вдвое меньше
+            rows = {row["url"]: row for row in log_analyzer.regression_rows(history_db, dates)}
+            self.assertEqual(set(rows), {"/api/v2/banner/0", "/api/v2/banner/1", "/api/v2/banner/3"})
+            self.assertEqual(rows["/api/v2/banner/1"]["time_sum_ratio"], 2.0)
+            self.assertEqual(rows["/api/v2/banner/1"]["time_med_base"], 0.15)
+            self.assertEqual(rows["/api/v2/banner/0"]["time_avg_ratio"], 1.0)
+            self.assertEqual(rows["/api/v2/banner/0"]["time_sum_ratio"], 2.0)
+            with self.assertRaises(ValueError):
+                log_analyzer.regression_rows(history_db, dates[-1:])
+            html_save = log_analyzer.build_regression_report(history_db, folder, dates)
+            self.assertEqual(os.path.basename(html_save), "regression-2017.06.29.html")
+
 
 if __name__ == "__main__":
     unittest.main()